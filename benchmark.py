@@ -0,0 +1,98 @@
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+import pygame
+
+from game import Game
+from scripts.asset_loader import CACHE_DIR
+
+# Run in a fresh interpreter for every startup measurement, prints seconds spent importing and then constructing the game
+STARTUP_SCRIPT = 'import time; start = time.perf_counter(); from game import Game; imported = time.perf_counter(); Game(headless=True); print(imported - start, time.perf_counter() - imported)'
+
+# A fixed input script: run right, jump every so often, dash now and then, then turn back.
+# Frame number -> list of (key, pressed), the same format Game.simulate takes.
+def scripted_inputs(frames):
+    inputs = {0: [(pygame.K_RIGHT, True)]}
+    for frame in range(frames):
+        events = inputs.setdefault(frame, [])
+        if frame % 45 == 20:
+            events.append((pygame.K_UP, True))
+        if frame % 45 == 24:
+            events.append((pygame.K_UP, False))
+        if frame % 90 == 60:
+            events.append((pygame.K_x, True))
+        if frame % 240 == 120:
+            events += [(pygame.K_RIGHT, False), (pygame.K_LEFT, True)]
+        if frame % 240 == 0 and frame:
+            events += [(pygame.K_LEFT, False), (pygame.K_RIGHT, True)]
+    return inputs
+
+def startup(runs):
+    # Cold starts have no asset cache (it's deleted before each one), warm starts reuse the one the run before left
+    for kind in ('cold', 'warm'):
+        times = []
+        for run in range(runs):
+            if kind == 'cold':
+                shutil.rmtree(CACHE_DIR, ignore_errors=True)
+            result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True, check=True, env=dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT='1'))
+            times.append([float(seconds) for seconds in result.stdout.split()[-2:]])
+        imports = statistics.median(seconds[0] for seconds in times) * 1000
+        init = statistics.median(seconds[1] for seconds in times) * 1000
+        print(kind + ' startup: ' + format(imports + init, '.1f') + ' ms (imports ' + format(imports, '.1f') + ' ms, Game() ' + format(init, '.1f') + ' ms), median of ' + str(runs))
+
+def main():
+    parser = argparse.ArgumentParser(description='Plays every map headless for a number of frames and reports ticks/sec and time per stage.')
+    parser.add_argument('--frames', type=int, default=600, help='frames to simulate per map')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help='also write every frame\'s stage times and counts to this CSV file')
+    parser.add_argument('--trace', help='also write every frame as a Chrome trace (chrome://tracing, Perfetto) to this JSON file')
+    parser.add_argument('--memory', action='store_true', help='track allocations and GC pauses per stage and print a report per map (much slower)')
+    parser.add_argument('--alloc-budget', type=float, default=64, help='KiB a frame may allocate before --memory flags it')
+    parser.add_argument('--time-budget', type=float, default=1000 / 60, help='ms a frame may take before --memory flags it')
+    parser.add_argument('--startup', type=int, metavar='RUNS', help='instead time starting the game RUNS times with no asset cache and RUNS times with it')
+    args = parser.parse_args()
+
+    if args.startup:
+        startup(args.startup)
+        return
+
+    game = Game(headless=True, seed=args.seed)
+    game.profiler.enabled = True
+    if args.csv or args.trace:
+        game.profiler.start_recording()
+    if args.memory:
+        game.memory_tracker.alloc_budget = args.alloc_budget * 1024
+        game.memory_tracker.time_budget = args.time_budget
+        game.toggle_memory_tracking()
+    inputs = scripted_inputs(args.frames)
+
+    for map_id in range(len(game.level_loader)):
+        game.level = map_id
+        game.load_level(map_id)
+        game.movement = [False, False]
+        game.profiler.reset()
+
+        start = time.perf_counter()
+        game.simulate(args.frames, inputs)
+        elapsed = time.perf_counter() - start
+
+        print('map ' + str(map_id) + ': ' + str(args.frames) + ' frames in ' + format(elapsed, '.2f') + 's, ' + format(args.frames / elapsed, '.1f') + ' ticks/sec')
+        total = sum(game.profiler.totals.values())
+        for stage, seconds in sorted(game.profiler.totals.items(), key=lambda item: -item[1]):
+            print('    ' + stage.ljust(12) + format(seconds * 1000 / game.profiler.frames, '8.3f') + ' ms/frame ' + format(seconds / total * 100, '6.1f') + '%')
+        print('    p99 frame   ' + format(dict((stage, p99) for stage, avg, p99 in game.profiler.rolling_stats())['total'], '8.3f') + ' ms (last ' + str(len(game.profiler.history)) + ' frames)')
+
+    if args.memory:
+        game.toggle_memory_tracking() # Prints the report
+    if args.csv:
+        game.profiler.export_csv(args.csv)
+    if args.trace:
+        game.profiler.export_trace(args.trace)
+
+if __name__ == '__main__':
+    main()
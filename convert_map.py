@@ -0,0 +1,36 @@
+import argparse
+import os
+
+from scripts.tilemap import Tilemap
+from scripts.world import is_world, read_world, save_world
+
+# Converts maps between JSON, the binary .lvl format and streamed .world directories, the output format comes from the output's extension.
+# Tilemap only needs assets for drawing, so no window is opened.
+class Converter:
+    def __init__(self):
+        self.assets = {}
+
+def size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a map between JSON, the binary .lvl format and a streamed .world directory (chosen by the output extension).')
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    args = parser.parse_args()
+
+    if is_world(args.source):
+        tilemap = read_world(Converter(), args.source)
+    else:
+        tilemap = Tilemap(Converter())
+        tilemap.load(args.source)
+    if args.destination.endswith('.world'):
+        save_world(tilemap, args.destination)
+    else:
+        tilemap.save(args.destination)
+    print(args.source + ' (' + str(size(args.source)) + ' bytes) -> ' + args.destination + ' (' + str(size(args.destination)) + ' bytes)')
+
+if __name__ == '__main__':
+    main()
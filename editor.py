@@ -1,7 +1,8 @@
 import pygame
 import sys
-from scripts.utils import load_images
+from scripts.asset_loader import AssetLoader
 from scripts.tilemap import Tilemap
+from scripts.world import StreamingTilemap
 
 RENDER_SCALE = 2.0
 
@@ -15,21 +16,25 @@ class Editor:
 
         self.clock = pygame.time.Clock() # Limits FPS
     
-        # A dict story all game assets for efficient look up, when asking for an asset it calls a function from utils.py
-        self.assets = {
-            'decor': load_images('tiles/decor'),
-            'grass': load_images('tiles/grass'),
-            'large_decor': load_images('tiles/large_decor'),
-            'stone': load_images('tiles/stone'),
-            'spawners': load_images('tiles/spawners')
-        }
+        # A dict story all game assets for efficient look up, decoded on the asset loader's threads (see Game)
+        loader = AssetLoader()
+        self.assets = loader.resolve({
+            'decor': loader.images('tiles/decor'),
+            'grass': loader.images('tiles/grass'),
+            'large_decor': loader.images('tiles/large_decor'),
+            'stone': loader.images('tiles/stone'),
+            'spawners': loader.images('tiles/spawners')
+        })
+        loader.shutdown()
 
         self.movement = [False, False, False, False] # For movement in all directions
 
-        self.tilemap = Tilemap(self, 16)
+        # A map path ending in .world is edited as a streamed world, saving only writes the regions that were changed
+        self.map_path = sys.argv[1] if len(sys.argv) > 1 else 'map.json'
+        self.tilemap = (StreamingTilemap if self.map_path.endswith('.world') else Tilemap)(self, 16)
 
         try:
-            self.tilemap.load('map.json')
+            self.tilemap.load(self.map_path)
         except FileNotFoundError:
             pass
 
@@ -40,6 +45,7 @@ class Editor:
         self.tile_variant = 0
 
         self.clicking = False
+        self.last_paint = None
         self.right_clicking = False
         self.shift = False
         self.ongrid = True
@@ -52,6 +58,7 @@ class Editor:
             self.scroll[1] += (self.movement[3] - self.movement[2]) * 2 # y axis camera 
             render_scroll = (int(self.scroll[0]), int(self.scroll[1]))
 
+            self.tilemap.stream(pygame.Rect(render_scroll, self.display.get_size()))
             self.tilemap.render(self.display, offset=render_scroll)
             current_tile_img = self.assets[self.tile_list[self.tile_group]][self.tile_variant].copy()
             current_tile_img.set_alpha(100)
@@ -65,19 +72,18 @@ class Editor:
             else:
                 self.display.blit(current_tile_img, mpos)
 
-            # Saves to tilemap (dict)
-            if self.clicking and self.ongrid:
-                self.tilemap.tilemap[str(tile_pos[0]) + ';' + str(tile_pos[1])] = {'type': self.tile_list[self.tile_group], 'variant': self.tile_variant, 'pos': tile_pos}
+            # Saves to tilemap, autotiling just the tiles around the change. Holding the mouse on the same spot only paints once,
+            # otherwise the chosen variant and the autotiled one would keep replacing each other.
+            if self.clicking and self.ongrid and (tile_pos, self.tile_group, self.tile_variant) != self.last_paint:
+                if self.tilemap.set_tile(tile_pos, self.tile_list[self.tile_group], self.tile_variant):
+                    self.tilemap.autotile_at(tile_pos)
+                self.last_paint = (tile_pos, self.tile_group, self.tile_variant)
             if self.right_clicking:
                 # Deletes from tilemap
-                tile_loc = str(tile_pos[0]) + ';' + str(tile_pos[1])
-                if tile_loc in self.tilemap.tilemap:
-                    del self.tilemap.tilemap[tile_loc]
-                for tile in self.tilemap.offgrid_tiles.copy():
-                    tile_img =  self.assets[tile['type']][tile['variant']]
-                    tile_r = pygame.Rect(tile['pos'][0] - self.scroll[0], tile['pos'][1] - self.scroll[1], tile_img.get_width(), tile_img.get_height())
-                    if tile_r.collidepoint(mpos):
-                        self.tilemap.offgrid_tiles.remove(tile)
+                if self.tilemap.remove_tile(tile_pos):
+                    self.tilemap.autotile_at(tile_pos)
+                for tile in self.tilemap.offgrid_at((mpos[0] + self.scroll[0], mpos[1] + self.scroll[1])):
+                    self.tilemap.remove_offgrid(tile)
 
             for event in pygame.event.get(): # Checks inputs from Windows OS
                 if event.type == pygame.QUIT:
@@ -87,7 +93,7 @@ class Editor:
                     if event.button == 1:
                         self.clicking = True
                         if not self.ongrid:
-                            self.tilemap.offgrid_tiles.append({'type': self.tile_list[self.tile_group], 'variant': self.tile_variant, 'pos': (mpos[0] + self.scroll[0], mpos[1] + self.scroll[1])})
+                            self.tilemap.add_offgrid({'type': self.tile_list[self.tile_group], 'variant': self.tile_variant, 'pos': (mpos[0] + self.scroll[0], mpos[1] + self.scroll[1])})
                     if event.button == 3:
                         self.right_clicking = True
                     if self.shift:
@@ -105,6 +111,7 @@ class Editor:
                 if event.type == pygame.MOUSEBUTTONUP:
                     if event.button == 1:
                         self.clicking = False
+                        self.last_paint = None
                     if event.button == 3:
                         self.right_clicking = False
                                         
@@ -122,7 +129,7 @@ class Editor:
                     if event.key == pygame.K_t:
                         self.tilemap.autotile()
                     if event.key == pygame.K_o:
-                        self.tilemap.save('map.json')
+                        self.tilemap.save(self.map_path)
                     if event.key == pygame.K_LSHIFT:
                         self.shift = True
                 if event.type == pygame.KEYUP:
@@ -5,224 +5,338 @@ import random
 import math
 
 from scripts.entities import Player, Enemy
-from scripts.utils import load_image, load_images, Animation
+from scripts.utils import preload_outlines, flip
+from scripts.asset_loader import AssetLoader
 from scripts.tilemap import Tilemap
+from scripts.level_loader import LevelLoader
 from scripts.clouds import Clouds
-from scripts.particle import Particle
-from scripts.spark import Spark
+from scripts.particle import ParticleSystem
+from scripts.spark import SparkSystem
+from scripts.projectile import ProjectileSystem
+from scripts.profiler import Profiler, ProfilerOverlay
+from scripts.memory_tracker import MemoryTracker
+from scripts.spatial_hash import SpatialHash
+from scripts.enemy_controller import EnemyController
+from scripts.compositor import Compositor
+
+SFX_VOLUMES = {'jump': 0.7, 'dash': 0.3, 'hit': 0.8, 'shoot': 0.4, 'ambience': 0.2}
+ACTIVE_MARGIN = 128 # Enemies further than this many pixels outside the camera are asleep (no AI, physics or drawing)
+RENDER_MARGIN = 16 # Enemies are drawn if their rect grown by this much touches the camera (covers the gun and animation offset)
+
+class SilentSound: # Stands in for pygame.mixer.Sound when running headless
+    def play(self, *args, **kwargs):
+        pass
+
+    def set_volume(self, volume):
+        pass
 
 class Game:
-    def __init__(self):
+    def __init__(self, headless=False, seed=None):
+        self.headless = headless
+        if headless:
+            # SDL's dummy drivers let the game run with no window or sound card, e.g. for benchmarks and scripted runs
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            os.environ['SDL_AUDIODRIVER'] = 'dummy'
+        if seed is not None:
+            random.seed(seed) # Everything random in the game goes through the random module, so one seed makes a run repeatable
+
         pygame.init() # Starts up pygame
         pygame.display.set_caption('gamer time')
 
         self.screen = pygame.display.set_mode((640, 480)) # The window of the game, initalised with a size 640x480
         self.display = pygame.Surface((320, 240), pygame.SRCALPHA) # Actual surface of the window
         self.display_2 = pygame.Surface((320, 240))
+        self.compositor = Compositor(self.display, self.display_2, self.screen)
 
         self.clock = pygame.time.Clock() # Limits FPS
 
         self.movement = [False, False] # Which key we are holding 0 for LEFT 1 for RIGHT
     
-        # A dict story all game assets for efficient look up, when asking for an asset it calls a function from utils.py
+        # A dict story all game assets for efficient look up. Images and sounds are decoded on the asset loader's threads
+        # (from its cache when they haven't changed) and only converted for the display here.
+        loader = AssetLoader()
         self.assets = {
-            'decor': load_images('tiles/decor'),
-            'grass': load_images('tiles/grass'),
-            'large_decor': load_images('tiles/large_decor'),
-            'stone': load_images('tiles/stone'),
-            'player': load_image('entities/player.png'),
-            'background': load_image('background.png'),
-            'clouds': load_images('clouds'),
-            'enemy/idle': Animation(load_images('entities/enemy/idle'), 6),
-            'enemy/run': Animation(load_images('entities/enemy/run'), 4),
-            'player/idle': Animation(load_images('entities/player/idle'), 6),
-            'player/run': Animation(load_images('entities/player/run'), 4),
-            'player/jump': Animation(load_images('entities/player/jump')),
-            'player/slide': Animation(load_images('entities/player/slide')),
-            'player/wall_slide': Animation(load_images('entities/player/wall_slide')),
-            'particle/leaf': Animation(load_images('particles/leaf'), img_dur=20, loop=False),
-            'particle/particle': Animation(load_images('particles/particle'), img_dur=6, loop=False),
-            'gun': load_image('gun.png'),
-            'projectile': load_image('projectile.png')
+            'decor': loader.images('tiles/decor'),
+            'grass': loader.images('tiles/grass'),
+            'large_decor': loader.images('tiles/large_decor'),
+            'stone': loader.images('tiles/stone'),
+            'player': loader.image('entities/player.png'),
+            'background': loader.image('background.png'),
+            'clouds': loader.images('clouds'),
+            'enemy/idle': loader.animation('entities/enemy/idle', 6),
+            'enemy/run': loader.animation('entities/enemy/run', 4),
+            'player/idle': loader.animation('entities/player/idle', 6),
+            'player/run': loader.animation('entities/player/run', 4),
+            'player/jump': loader.animation('entities/player/jump'),
+            'player/slide': loader.animation('entities/player/slide'),
+            'player/wall_slide': loader.animation('entities/player/wall_slide'),
+            'particle/leaf': loader.animation('particles/leaf', img_dur=20, loop=False),
+            'particle/particle': loader.animation('particles/particle', img_dur=6, loop=False),
+            'gun': loader.image('gun.png'),
+            'projectile': loader.image('projectile.png')
         }
+        sfx = {name: SilentSound() if headless else loader.sound('data/sfx/' + name + '.wav') for name in SFX_VOLUMES}
+        self.assets = loader.resolve(self.assets)
+        self.sfx = loader.resolve(sfx)
+        loader.shutdown()
 
-        self.sfx = {
-            'jump': pygame.mixer.Sound('data/sfx/jump.wav'),
-            'dash': pygame.mixer.Sound('data/sfx/dash.wav'),
-            'hit': pygame.mixer.Sound('data/sfx/hit.wav'),
-            'shoot': pygame.mixer.Sound('data/sfx/shoot.wav'),
-            'ambience': pygame.mixer.Sound('data/sfx/ambience.wav')
-        }
+        # Everything drawn with a drop outline gets its outline made now rather than the first time it's drawn
+        preload_outlines([self.assets[name] for name in self.assets if name not in {'background', 'clouds', 'player'}] + [flip(self.assets['gun'])])
+
+        for name in SFX_VOLUMES:
+            self.sfx[name].set_volume(SFX_VOLUMES[name])
 
-        self.sfx['ambience'].set_volume(0.2)
-        self.sfx['shoot'].set_volume(0.4)
-        self.sfx['hit'].set_volume(0.8)
-        self.sfx['dash'].set_volume(0.3)
-        self.sfx['jump'].set_volume(0.7)
+        self.profiler = Profiler()
+        self.profiler_overlay = ProfilerOverlay(self.profiler) # F3 shows it, F4 starts/stops recording a profile to disk
+        self.memory_tracker = MemoryTracker() # F5 starts/stops it, printing its report when it stops
 
         self.clouds = Clouds(self.assets['clouds'], 16)
 
+        self.sparks = SparkSystem()
+        self.projectiles = ProjectileSystem(self.assets['projectile'])
+        self.particles = ParticleSystem({'leaf': self.assets['particle/leaf'], 'particle': self.assets['particle/particle']})
+
+        self.spatial_hash = SpatialHash() # Every entity by position, for overlap/radius queries between entities and projectiles
+        self.active_margin = ACTIVE_MARGIN
+        self.enemy_controller = EnemyController(self)
+
         self.player = Player(self, (50, 50), (8, 15))
 
         self.tilemap = Tilemap(self, 16)
+        self.level_loader = LevelLoader(self)
 
         self.level = 0
         self.load_level(self.level)
 
         self.screenshake = 0
 
-    def load_level(self, map_id):
-        self.tilemap.load('data/maps/' + str(map_id) + '.json')
+    def next_level(self):
+        # The last map is replayed once it's beaten
+        return min(self.level + 1, len(self.level_loader) - 1)
 
-        self.leaf_spawners = []
-        for tree in self.tilemap.extract([('large_decor', 2)], keep=True):
-            self.leaf_spawners.append(pygame.Rect(4 + tree['pos'][0], 4 + tree['pos'][1], 23, 13))
+    def load_level(self, map_id):
+        if self.memory_tracker.active:
+            self.memory_tracker.begin_level(map_id)
+        # The map is normally already read and parsed on the level loader's thread, so this just swaps it in
+        level_data = self.level_loader.get(map_id)
+        self.tilemap = level_data.tilemap
+        self.leaf_spawners = level_data.leaf_spawners
         
-        self.enemies = []
-        for spawner in self.tilemap.extract([('spawners', 0), ('spawners', 1)]):
+        self.player_spawn = (50, 50)
+        self.level_enemies = [] # Every enemy the level starts with, kept so restarts can reset them rather than make new ones
+        for spawner in level_data.spawners:
             if spawner['variant'] == 0:
-                self.player.pos = spawner['pos']
-                self.player.air_time = 0
+                self.player_spawn = tuple(spawner['pos'])
             else:
-                self.enemies.append(Enemy(self, spawner['pos'], (8, 15)))
-
-        self.projectiles = []
-        self.particles = []
-        self.sparks = []
+                self.level_enemies.append(Enemy(self, spawner['pos'], (8, 15)))
+        self.enemy_controller.load(self.level_enemies)
+
+        # The level as it is now (spawners taken out) is what every restart goes back to
+        self.level_snapshot = self.tilemap.snapshot()
+        self.restart_level()
+
+        self.level_loader.prefetch(self.next_level())
+
+    def restart_level(self):
+        # Puts the level back to how it was just after loading, all from memory. The tilemap only copies anything if it was changed,
+        # and the enemies are reset in place.
+        self.tilemap.restore(self.level_snapshot)
+
+        self.spatial_hash.clear()
+        self.player.pos = list(self.player_spawn)
+        self.player.air_time = 0
+        self.spatial_hash.update(self.player, self.player.rect())
+        self.enemies = list(self.level_enemies)
+        self.enemy_controller.reset()
+        for enemy in self.enemies:
+            enemy.reset()
+            self.spatial_hash.update(enemy, enemy.rect())
+
+        self.projectiles.clear()
+        self.particles.clear()
+        self.sparks.clear()
 
         self.scroll = [0, 0]
         self.dead = 0
         self.transition = -30
 
+    def step(self):
+        # Advances the world by one fixed step (the game is tuned for 60 of these a second) and draws it onto display and display_2
+        self.profiler.stage('level')
+        self.display.fill((0, 0, 0, 0))
+        self.display_2.blit(self.assets['background'], (0, 0)) # Covers everything from the last update, refreshing the screen
+
+        self.screenshake = max(0, self.screenshake - 1)
+
+        if not len(self.enemies):
+            self.transition += 1
+            if self.transition > 30:
+                self.level = self.next_level()
+                self.load_level(self.level)
+        if self.transition < 0:
+            self. transition += 1
+
+        if self.dead:
+            self.dead += 1
+            if self.dead >= 10:
+                self.transition = min(30, self.transition + 1)
+            if self.dead > 40:
+                self.restart_level()
+
+        # Special math thing to make it move smoother to the character
+        # Take X/Y (player location) and minus from half the width/height to place the character in the centre (otherwise they would be in the top left)
+        # We then subtract what we have currently to calculate the distance for the camera to travel
+        # Divide by 30 to only apply 1/30th of the distance for smoothness, the larger the distance the faster, the closer the slower.
+        self.scroll[0] += (self.player.rect().centerx - self.display.get_width() / 2  - self.scroll[0]) / 30
+        self.scroll[1] += (self.player.rect().centery - self.display.get_height() / 2 - self.scroll[1]) / 30
+        render_scroll = (int(self.scroll[0]), int(self.scroll[1])) # Deals with floats that cause jittering, this is now applied as the offset.
+
+        self.profiler.stage('leaves')
+        for rect in self.leaf_spawners:
+            if random.random() * 49999 < rect.width * rect.height:
+                pos = (rect.x + random.random() * rect.width, rect.y + random.random() * rect.height)
+                self.particles.spawn('leaf', pos, velocity=(-0.1, 0.3), frame=random.randint(0, 20))
+
+        self.profiler.stage('clouds')
+        self.clouds.update()
+        self.clouds.render(self.display_2, offset=render_scroll)
+
+        self.profiler.stage('tilemap')
+        self.tilemap.stream(pygame.Rect(render_scroll, self.display.get_size())) # Streamed worlds read the regions around the camera
+        self.tilemap.render(self.display, offset=render_scroll, shadow_surf=self.display_2)
+
+        self.profiler.stage('enemies')
+        # Only enemies near the camera are awake, the rest keep their place in the spatial hash and wake up once it reaches them.
+        # Awake enemies go in spawn order so runs stay deterministic.
+        camera = pygame.Rect(render_scroll, self.display.get_size())
+        awake = sorted(self.spatial_hash.query_rect(camera.inflate(self.active_margin * 2, self.active_margin * 2), Enemy), key=self.enemy_controller.slots.__getitem__)
+        for enemy, movement in zip(awake, self.enemy_controller.update(awake, self.tilemap)):
+            if enemy.update(self.tilemap, (movement, 0)):
+                self.enemies.remove(enemy)
+                self.spatial_hash.remove(enemy)
+        # Drawing is culled separately and tighter, to what's actually on screen
+        for enemy in awake:
+            if enemy in self.spatial_hash.entries and camera.colliderect(self.spatial_hash.rect(enemy).inflate(RENDER_MARGIN * 2, RENDER_MARGIN * 2)):
+                enemy.render(self.display, offset=render_scroll, shadow_surf=self.display_2)
+
+        self.profiler.stage('player')
+        if not self.dead:
+            self.player.update(self.tilemap, (self.movement[1] - self.movement[0], 0))
+            self.player.render(self.display, offset=render_scroll, shadow_surf=self.display_2)
+
+        self.profiler.stage('projectiles')
+        # Enemy shots can only hit the player, and not while they're dashing
+        wall_hits, player_hits = self.projectiles.update(self.spatial_hash, {self.player} if abs(self.player.dashing) < 50 else set(), self.display, offset=render_scroll, shadow_surf=self.display_2)
+        for pos, velocity in wall_hits:
+            for i in range(4):
+                self.sparks.spawn(pos, random.random() - 0.5 + (math.pi if velocity > 0 else 0), 2 + random.random())
+        for pos, target in player_hits:
+            self.dead += 1
+            self.sfx['hit'].play()
+            self.screenshake = max(16, self.screenshake)
+            for i in range(30):
+                angle = random.random() * math.pi * 2
+                speed = random.random() * 5
+                self.sparks.spawn(self.player.rect().center, angle, 2 + random.random())
+                self.particles.spawn('particle', self.player.rect().center, velocity=(math.cos(angle + math.pi) * speed * 0.5, math.sin(angle + math.pi) * speed * 0.5), frame=random.randint(0, 7))
+
+        self.profiler.stage('sparks')
+        self.sparks.update(self.display, offset=render_scroll, shadow_surf=self.display_2)
+
+        self.profiler.stage('particles')
+        self.particles.update(self.display, offset=render_scroll)
+
+        if self.profiler.enabled:
+            self.profiler.count('enemies', len(self.enemies))
+            self.profiler.count('projectiles', len(self.projectiles))
+            self.profiler.count('sparks', len(self.sparks))
+            self.profiler.count('particles', len(self.particles))
+
+    def key_down(self, key):
+        if key == pygame.K_LEFT:
+            self.movement[0] = True
+        if key == pygame.K_RIGHT:
+            self.movement[1] = True
+        if key == pygame.K_UP:
+            if self.player.jump():
+                self.sfx['jump'].play()
+        if key == pygame.K_x:
+            self.player.dash()
+        if key == pygame.K_F3:
+            self.profiler_overlay.toggle()
+        if key == pygame.K_F4:
+            if self.profiler.recording:
+                self.profiler.stop_recording()
+                self.profiler.export_csv('profile.csv')
+                self.profiler.export_trace('profile_trace.json')
+            else:
+                self.profiler.start_recording()
+            self.profiler.update_enabled(self.profiler_overlay.visible)
+        if key == pygame.K_F5:
+            self.toggle_memory_tracking()
+
+    def toggle_memory_tracking(self):
+        if self.memory_tracker.active:
+            self.memory_tracker.stop()
+            self.profiler.memory = None
+            self.profiler.update_enabled(self.profiler_overlay.visible)
+            print(self.memory_tracker.report())
+        else:
+            self.memory_tracker.start()
+            self.memory_tracker.begin_level(self.level)
+            self.profiler.memory = self.memory_tracker
+            self.profiler.update_enabled(self.profiler_overlay.visible)
+
+    def key_up(self, key):
+        if key == pygame.K_LEFT:
+            self.movement[0] = False
+        if key == pygame.K_RIGHT:
+            self.movement[1] = False
+
+    def handle_events(self):
+        self.profiler.stage('events')
+        for event in pygame.event.get(): # Checks inputs from Windows OS
+            if event.type == pygame.QUIT:
+                self.level_loader.shutdown()
+                pygame.quit() # Closes pygame
+                sys.exit() # Closes the application
+            if event.type == pygame.KEYDOWN:
+                self.key_down(event.key)
+            if event.type == pygame.KEYUP:
+                self.key_up(event.key)
+
+    def present(self):
+        self.profiler.stage('present')
+        screenshake_offset = (random.random() * self.screenshake - self.screenshake / 2, random.random() * self.screenshake - self.screenshake / 2)
+        self.compositor.present(self.transition, screenshake_offset)
+        self.profiler_overlay.render(self.screen)
+        pygame.display.update() # Updates the display
+        self.profiler.end_frame()
+
+    def simulate(self, frames, inputs={}):
+        # Runs frames fixed steps back to back with no frame cap. inputs maps a frame number to a list of (key, pressed) pairs,
+        # which go through the same key_down/key_up as real key presses, so a seeded game plus a script always plays out the same way.
+        for frame in range(frames):
+            for key, pressed in inputs.get(frame, []):
+                if pressed:
+                    self.key_down(key)
+                else:
+                    self.key_up(key)
+            self.step()
+            self.profiler.stage('events')
+            pygame.event.pump() # Keeps SDL's queue from filling up, the events themselves are ignored
+            self.present()
+
     def run(self):
         pygame.mixer.music.load('data/music.wav')
         pygame.mixer.music.set_volume(0.5)
         pygame.mixer.music.play(-1)
 
         while True:
-            self.display.fill((0, 0, 0, 0))
-            self.display_2.blit(self.assets['background'], (0, 0)) # Covers everything from the last update, refreshing the screen
-
-            self.screenshake = max(0, self.screenshake - 1)
-
-            if not len(self.enemies):
-                self.transition += 1
-                if self.transition > 30:
-                    self.level = min(self.level + 1, len(os.listdir('data/maps')) - 1)
-                    self.load_level(self.level)
-            if self.transition < 0:
-                self. transition += 1
-
-            if self.dead:
-                self.dead += 1
-                if self.dead >= 10:
-                    self.transition = min(30, self.transition + 1)
-                if self.dead > 40:
-                    self.load_level(self.level)
-
-            # Special math thing to make it move smoother to the character
-            # Take X/Y (player location) and minus from half the width/height to place the character in the centre (otherwise they would be in the top left)
-            # We then subtract what we have currently to calculate the distance for the camera to travel
-            # Divide by 30 to only apply 1/30th of the distance for smoothness, the larger the distance the faster, the closer the slower.
-            self.scroll[0] += (self.player.rect().centerx - self.display.get_width() / 2  - self.scroll[0]) / 30
-            self.scroll[1] += (self.player.rect().centery - self.display.get_height() / 2 - self.scroll[1]) / 30
-            render_scroll = (int(self.scroll[0]), int(self.scroll[1])) # Deals with floats that cause jittering, this is now applied as the offset.
-
-            for rect in self.leaf_spawners:
-                if random.random() * 49999 < rect.width * rect.height:
-                    pos = (rect.x + random.random() * rect.width, rect.y + random.random() * rect.height)
-                    self.particles.append(Particle(self, 'leaf', pos, velocity=[-0.1, 0.3], frame=random.randint(0, 20)))
-
-            self.clouds.update()
-            self.clouds.render(self.display_2, offset=render_scroll)
-
-            self.tilemap.render(self.display, offset=render_scroll)
-
-            for enemy in self.enemies.copy():
-                kill = enemy.update(self.tilemap, (0, 0))
-                enemy.render(self.display, offset=render_scroll)
-                if kill:
-                    self.enemies.remove(enemy)
-
-            if not self.dead:
-                self.player.update(self.tilemap, (self.movement[1] - self.movement[0], 0))
-                self.player.render(self.display, offset=render_scroll)
-
-            # [[x, y], direction, timer]
-            for projectile in self.projectiles.copy():
-                projectile[0][0] += projectile[1]
-                projectile[2] += 1
-                img = self.assets['projectile']
-                self.display.blit(img, (projectile[0][0] - img.get_width() / 2 - render_scroll[0], projectile[0][1] - img.get_height() / 2 - render_scroll[1]))
-                if self.tilemap.solid_check(projectile[0]):
-                    self.projectiles.remove(projectile)
-                    for i in range(4):
-                        self.sparks.append(Spark(projectile[0], random.random() - 0.5 + (math.pi if projectile[1] > 0 else 0), 2 + random.random()))
-                elif projectile[2] > 360:
-                    self.projectiles.remove(projectile)
-                elif abs(self.player.dashing) < 50:
-                    if self.player.rect().collidepoint(projectile[0]):
-                        self.projectiles.remove(projectile)
-                        self.dead += 1
-                        self.sfx['hit'].play()
-                        self.screenshake = max(16, self.screenshake)
-                        for i in range(30):
-                            angle = random.random() * math.pi * 2
-                            speed = random.random() * 5
-                            self.sparks.append(Spark(self.player.rect().center, angle, 2 + random.random()))
-                            self.particles.append(Particle(self, 'particle', self.player.rect().center, velocity=[math.cos(angle + math.pi) * speed * 0.5, math.sin(angle + math.pi) * speed * 0.5], frame=random.randint(0, 7)))
-
-            for spark in self.sparks.copy():
-                kill = spark.update()
-                spark.render(self.display, offset=render_scroll)
-                if kill:
-                    self.sparks.remove(spark)
-
-            display_mask = pygame.mask.from_surface(self.display)
-            display_silhouette = display_mask.to_surface(setcolor=(0, 0, 0, 180), unsetcolor=(0, 0, 0, 0))
-            for offset in [(-1, 0), (1, 0), (0, 1), (0, -1)]:
-                self.display_2.blit(display_silhouette, offset)
-
-            particle: Particle
-            for particle in self.particles.copy():
-                kill = particle.update()
-                particle.render(self.display, render_scroll)
-                if particle.type == 'leaf':
-                    particle.pos[0] += math.sin(particle.animation.frame * 0.035) * 0.3
-                if kill:
-                    self.particles.remove(particle)
-
-            for event in pygame.event.get(): # Checks inputs from Windows OS
-                if event.type == pygame.QUIT:
-                    pygame.quit() # Closes pygame
-                    sys.exit() # Closes the application
-                if event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_LEFT:
-                        self.movement[0] = True
-                    if event.key == pygame.K_RIGHT:
-                        self.movement[1] = True
-                    if event.key == pygame.K_UP:
-                        if self.player.jump():
-                            self.sfx['jump'].play()
-                    if event.key == pygame.K_x:
-                        self.player.dash()
-                if event.type == pygame.KEYUP:
-                    if event.key == pygame.K_LEFT:
-                        self.movement[0] = False
-                    if event.key == pygame.K_RIGHT:
-                        self.movement[1] = False
-
-            if self.transition:
-                transition_surf = pygame.Surface(self.display.get_size())
-                pygame.draw.circle(transition_surf, (255, 255, 255), (self.display.get_width() // 2, self.display.get_height() // 2), (30 - abs(self.transition)) * 8)
-                transition_surf.set_colorkey((255, 255, 255))
-                self.display.blit(transition_surf, (0, 0))
-            
-            self.display_2.blit(self.display, (0, 0))
-
-            screenshake_offset = (random.random() * self.screenshake - self.screenshake / 2, random.random() * self.screenshake - self.screenshake / 2)
-            self.screen.blit(pygame.transform.scale(self.display_2, self.screen.get_size()), screenshake_offset)
-            pygame.display.update() # Updates the display
+            self.step()
+            self.handle_events()
+            self.present()
             self.clock.tick(60) # Forces 60 FPS
 
-Game().run()
\ No newline at end of file
+if __name__ == '__main__':
+    Game().run()
@@ -0,0 +1,106 @@
+import hashlib
+import os
+import struct
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pygame
+
+from scripts.utils import BASE_IMG_PATH, Animation, prepare_image
+
+CACHE_DIR = '.asset_cache' # Decoded images, safe to delete (it's rebuilt on the next start)
+CACHE_VERSION = 1
+WORKERS = 4
+
+# A cache file is this header (version, the source's mtime in ns and size, the SHA-1 of the source, width, height) then raw RGBA pixels
+CACHE_HEADER = struct.Struct('<HqQ20sII')
+
+class PendingAnimation:
+    # What AssetLoader.animation() hands back: the frames being decoded plus the Animation arguments for once they're done
+    def __init__(self, frames, args, kwargs):
+        self.frames = frames
+        self.args = args
+        self.kwargs = kwargs
+
+class AssetLoader:
+    # Decodes images and sounds on a thread pool so they load in parallel, keeping decoded pixels in an on-disk cache.
+    # A cache entry is used while its source's mtime and size are unchanged, or, if those changed, while its contents hash the same.
+    # Only convert() depends on the display, so that's the one step done on the main thread, in resolve().
+    def __init__(self, cache_dir=CACHE_DIR, workers=WORKERS):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asset-loader')
+        self.hits = 0
+        self.misses = 0
+
+    def image(self, path):
+        return self.executor.submit(self.decode, path)
+
+    def images(self, path):
+        # A folder's images in name order, each decoded on its own
+        return [self.image(path + '/' + img_name) for img_name in sorted(os.listdir(BASE_IMG_PATH + path))]
+
+    def animation(self, path, *args, **kwargs):
+        return PendingAnimation(self.images(path), args, kwargs)
+
+    def sound(self, path):
+        return self.executor.submit(pygame.mixer.Sound, path)
+
+    def resolve(self, pending):
+        # Swaps every future in a dict or list (or a single one) for what it loaded, converting images for the display.
+        # Waits for the pool to finish, so nothing is left running once assets are in use.
+        if isinstance(pending, dict):
+            return {name: self.resolve(value) for name, value in pending.items()}
+        if isinstance(pending, list):
+            return [self.resolve(value) for value in pending]
+        if isinstance(pending, PendingAnimation):
+            return Animation(self.resolve(pending.frames), *pending.args, **pending.kwargs)
+        if isinstance(pending, Future):
+            loaded = pending.result()
+            return prepare_image(loaded) if isinstance(loaded, pygame.Surface) else loaded
+        return pending
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def cache_path(self, path):
+        return os.path.join(self.cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.img')
+
+    def decode(self, path):
+        # Runs on the pool: the cached pixels if they're still good, otherwise the PNG decoded and cached for next time
+        source = BASE_IMG_PATH + path
+        stat = os.stat(source)
+        cache_path = self.cache_path(path)
+        digest = None
+        try:
+            f = open(cache_path, 'rb')
+            data = f.read()
+            f.close()
+            version, mtime, size, cached_digest, width, height = CACHE_HEADER.unpack_from(data, 0)
+            if version == CACHE_VERSION and len(data) == CACHE_HEADER.size + width * height * 4:
+                if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+                    digest = self.digest(source) # Touched (e.g. checked out again) but maybe not changed
+                if digest is None or digest == cached_digest:
+                    if digest:
+                        self.write_cache(cache_path, stat, digest, width, height, data[CACHE_HEADER.size:])
+                    self.hits += 1
+                    return pygame.image.frombytes(data[CACHE_HEADER.size:], (width, height), 'RGBA')
+        except (OSError, struct.error):
+            pass # No cache entry yet, or a broken one that gets replaced
+
+        self.misses += 1
+        img = pygame.image.load(source)
+        self.write_cache(cache_path, stat, digest or self.digest(source), img.get_width(), img.get_height(), pygame.image.tobytes(img, 'RGBA'))
+        return img
+
+    def digest(self, source):
+        f = open(source, 'rb')
+        digest = hashlib.sha1(f.read()).digest()
+        f.close()
+        return digest
+
+    def write_cache(self, cache_path, stat, digest, width, height, pixels):
+        # Written under a temporary name first so a crash never leaves a half written entry behind
+        f = open(cache_path + '.tmp', 'wb')
+        f.write(CACHE_HEADER.pack(CACHE_VERSION, stat.st_mtime_ns, stat.st_size, digest, width, height) + pixels)
+        f.close()
+        os.replace(cache_path + '.tmp', cache_path)
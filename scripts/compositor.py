@@ -0,0 +1,28 @@
+import pygame
+
+TRANSITION_FRAMES = 30 # A level transition runs from -30 to 30, the circle is drawn for every frame it isn't 0
+
+class Compositor:
+    # Puts the finished frame on the screen using surfaces made once up front, so a normal frame creates no new surfaces:
+    # the scale goes into a reused buffer, the transition circles are all pre-drawn and screenshake is just where the buffer is blitted.
+    def __init__(self, display, display_2, screen):
+        self.display = display # Everything with an outline, drawn over display_2
+        self.display_2 = display_2 # Background, outlines and the final frame
+        self.screen = screen
+        self.scaled = pygame.Surface(screen.get_size(), 0, display_2) # transform.scale needs a destination in the source's format
+
+        # Black everywhere but a see-through (colour keyed) circle in the middle, shrinking as the transition goes on
+        w, h = display.get_size()
+        self.transition_masks = [None]
+        for step in range(1, TRANSITION_FRAMES + 1):
+            mask = pygame.Surface((w, h))
+            pygame.draw.circle(mask, (255, 255, 255), (w // 2, h // 2), (TRANSITION_FRAMES - step) * 8)
+            mask.set_colorkey((255, 255, 255))
+            self.transition_masks.append(mask.convert())
+
+    def present(self, transition=0, shake_offset=(0, 0)):
+        if transition:
+            self.display.blit(self.transition_masks[abs(transition)], (0, 0))
+        self.display_2.blit(self.display, (0, 0))
+        pygame.transform.scale(self.display_2, self.screen.get_size(), self.scaled)
+        self.screen.blit(self.scaled, shake_offset)
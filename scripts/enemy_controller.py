@@ -0,0 +1,98 @@
+import math
+import random
+
+import numpy as np
+
+from scripts.projectile import PROJECTILE_LIFETIME, PROJECTILE_SPEED
+
+WALK_CHANCE = 0.01 # Chance per frame that an idle enemy starts walking
+WALK_FRAMES = (30, 120) # How long a walk lasts, inclusive
+LEDGE_PROBE = (7, 23) # Ground is looked for this far ahead of the enemy's centre and below its top
+FIRE_BAND = 16 # The player has to be within this many pixels vertically to be shot at
+
+class EnemyController:
+    # Runs the AI of every awake enemy at once. Walk timers live in an array indexed by each enemy's slot (its spawn order
+    # in the level), and ledge probes, the player checks and the walk rolls are worked out for all of them in a few NumPy
+    # operations. Physics, animation and getting dashed through stay on the Enemy objects.
+    def __init__(self, game):
+        self.game = game
+        self.rng = np.random.default_rng(random.getrandbits(64)) # Drawn from random so seeded games stay deterministic
+        self.load([])
+
+    def load(self, enemies):
+        self.slots = {enemy: i for i, enemy in enumerate(enemies)}
+        self.walking = np.zeros(len(enemies), dtype=np.int64) # Frames of walking left
+        self.half_size = np.array([(enemy.size[0] // 2, enemy.size[1] // 2) for enemy in enemies], dtype=np.int64).reshape(-1, 2)
+        self.height = np.array([enemy.size[1] for enemy in enemies], dtype=np.int64)
+
+    def reset(self):
+        self.walking[:] = 0
+
+    def update(self, enemies, tilemap):
+        # enemies have to be in slot order for the random rolls to come out the same every run.
+        # Returns each enemy's horizontal movement for this frame, and fires for the ones that stopped walking in sight of the player.
+        if not enemies:
+            return []
+        slots = np.fromiter((self.slots[enemy] for enemy in enemies), dtype=np.int64, count=len(enemies))
+        pos = np.array([enemy.pos for enemy in enemies], dtype=float)
+        flip = np.array([enemy.flip for enemy in enemies], dtype=bool)
+        walled = np.array([enemy.collisions['right'] or enemy.collisions['left'] for enemy in enemies], dtype=bool)
+        walking = self.walking[slots]
+        movement = np.zeros(len(enemies))
+
+        # Entity rects truncate positions, so the centres used here do too
+        center = np.trunc(pos).astype(np.int64) + self.half_size[slots]
+
+        moving = np.flatnonzero(walking > 0)
+        idle = np.flatnonzero(walking == 0) # Enemies that stop walking this frame wait until the next one to roll
+        if len(moving):
+            # Walking enemies turn around at walls and ledges, otherwise keep going the way they face
+            probes = np.column_stack((center[moving, 0] + np.where(flip[moving], -LEDGE_PROBE[0], LEDGE_PROBE[0]), pos[moving, 1] + LEDGE_PROBE[1]))
+            ground = tilemap.solid_check_many(probes)
+            turn = ~ground | walled[moving]
+            movement[moving] = np.where(turn, 0, np.where(flip[moving], -0.5, 0.5))
+            flip[moving] ^= turn
+            walking[moving] -= 1
+            self.fire(moving[walking[moving] == 0], pos, flip, center, slots, tilemap)
+
+        if len(idle):
+            starts = idle[self.rng.random(len(idle)) < WALK_CHANCE]
+            walking[starts] = self.rng.integers(WALK_FRAMES[0], WALK_FRAMES[1] + 1, len(starts))
+
+        self.walking[slots] = walking
+        for enemy, enemy_flip in zip(enemies, flip.tolist()):
+            enemy.flip = enemy_flip
+        return movement.tolist()
+
+    def fire(self, stopped, pos, flip, center, slots, tilemap):
+        # Enemies that just finished a walk shoot if the player is in the band a shot could travel through (FIRE_BAND pixels
+        # either way vertically, as far as a projectile flies horizontally), on the side they face and in plain sight
+        if not len(stopped):
+            return
+        player = self.game.player
+        player_rect = player.rect()
+        shot_range = PROJECTILE_LIFETIME * PROJECTILE_SPEED
+        left = np.trunc(np.where(flip[stopped], pos[stopped, 0] - shot_range, pos[stopped, 0]))
+        top = np.trunc(pos[stopped, 1] - FIRE_BAND)
+        in_band = (player_rect.left < left + int(shot_range)) & (player_rect.right > left) & (player_rect.top < top + 2 * FIRE_BAND + self.height[slots[stopped]]) & (player_rect.bottom > top)
+        dist_x = player.pos[0] - pos[stopped, 0]
+        in_band &= (np.abs(player.pos[1] - pos[stopped, 1]) < FIRE_BAND) & np.where(flip[stopped], dist_x < 0, dist_x > 0)
+
+        # Only the few enemies that could fire need the line of sight raycast, and their shots all go out together afterwards
+        shots = []
+        for i in stopped[in_band].tolist():
+            muzzle = (int(center[i, 0]) + (-7 if flip[i] else 7), int(center[i, 1]))
+            sight = (player_rect.centerx - muzzle[0], player_rect.centery - muzzle[1])
+            if tilemap.raycast(muzzle, sight, math.hypot(sight[0], sight[1])) is None:
+                shots.append((muzzle, bool(flip[i])))
+
+        for muzzle, left_facing in shots:
+            if left_facing:
+                self.game.sfx['shoot'].play()
+                self.game.projectiles.spawn(muzzle, -PROJECTILE_SPEED, tilemap)
+                for i in range(4):
+                    self.game.sparks.spawn(muzzle, random.random() - 0.5 + math.pi, 2 + random.random())
+            else:
+                self.game.projectiles.spawn(muzzle, PROJECTILE_SPEED, tilemap)
+                for i in range(4):
+                    self.game.sparks.spawn(muzzle, random.random() - 0.5, 2 + random.random())
@@ -1,8 +1,7 @@
 import math
 import random
 import pygame
-from scripts.particle import Particle
-from scripts.spark import Spark
+from scripts.utils import outline, flip
 
 
 class PhysicsEntity:
@@ -30,21 +29,30 @@ class PhysicsEntity:
             self.animation = self.game.assets[self.type + '/' + self.action].copy()
 
     def update(self, tilemap, movement=(0,0)):
-        self.collisions = {'up': False, 'down': False, 'right': False, 'left': False}
+        collisions = self.collisions
+        collisions['up'] = collisions['down'] = collisions['right'] = collisions['left'] = False
         frame_movement = (movement[0] + self.velocity[0], movement[1] + self.velocity[1]) # Change position based on velocity
-        
+        tile_size = tilemap.tile_size
+        width, height = self.size
+
+        # Each axis is swept on its own: every tile column (then row) between where the entity was and where it ends up is
+        # checked nearest first, so nothing can be skipped over however fast the entity moves or however big it is.
+        # Positions are truncated the same way pygame.Rect truncates them.
+        old_left = int(self.pos[0])
         self.pos[0] += frame_movement[0]
-        
-        entity_rect = self.rect()
-        for rect in tilemap.physics_rects_around(self.pos):
-            if entity_rect.colliderect(rect):
-                if frame_movement[0] > 0:
-                    entity_rect.right = rect.left # If we are moving right, snap to the left side of the tile
-                    self.collisions['right'] = True
-                if frame_movement[0] < 0: # If we are moving left, snap to the left side of the tile
-                    entity_rect.left = rect.right
-                    self.collisions['left'] = True
-                self.pos[0] = entity_rect.x # Update the actual position of the entity to its rect
+        left = int(self.pos[0])
+        top = int(self.pos[1])
+        rows = range(top // tile_size, (top + height - 1) // tile_size + 1)
+        if frame_movement[0] > 0:
+            column = tilemap.first_solid(range(min(left, old_left + width) // tile_size, (left + width - 1) // tile_size + 1), rows)
+            if column is not None:
+                self.pos[0] = column * tile_size - width # Snap to the left side of the tile
+                collisions['right'] = True
+        elif frame_movement[0] < 0:
+            column = tilemap.first_solid(range((max(left + width, old_left) - 1) // tile_size, left // tile_size - 1, -1), rows)
+            if column is not None:
+                self.pos[0] = (column + 1) * tile_size # Snap to the right side of the tile
+                collisions['left'] = True
             
         if movement[0] > 0:
             self.flip = False
@@ -53,70 +61,74 @@ class PhysicsEntity:
 
         self.last_movement = movement
 
+        old_top = int(self.pos[1])
         self.pos[1] += frame_movement[1]
-        entity_rect = self.rect()
-        for rect in tilemap.physics_rects_around(self.pos):
-            if entity_rect.colliderect(rect):
-                if frame_movement[1] > 0:
-                    entity_rect.bottom = rect.top
-                    self.collisions['down'] = True
-                if frame_movement[1] < 0:
-                    entity_rect.top = rect.bottom
-                    self.collisions['up'] = True
-                self.pos[1] = entity_rect.y
+        left = int(self.pos[0])
+        top = int(self.pos[1])
+        columns = range(left // tile_size, (left + width - 1) // tile_size + 1)
+        if frame_movement[1] > 0:
+            row = tilemap.first_solid(range(min(top, old_top + height) // tile_size, (top + height - 1) // tile_size + 1), columns, vertical=True)
+            if row is not None:
+                self.pos[1] = row * tile_size - height
+                collisions['down'] = True
+        elif frame_movement[1] < 0:
+            row = tilemap.first_solid(range((max(top + height, old_top) - 1) // tile_size, top // tile_size - 1, -1), columns, vertical=True)
+            if row is not None:
+                self.pos[1] = (row + 1) * tile_size
+                collisions['up'] = True
 
         self.velocity[1] = min(5, self.velocity[1] + 0.1) # Simulates terminal velocity
 
         if self.collisions['down'] or self.collisions['up']: # Updates velocity to 0 
             self.velocity[1] = 0
+
+        self.game.spatial_hash.update(self, self.rect()) # Lets everything else find this entity by position
         
         self.animation.update()
 
     # When an object is rendered, an offset is subtracted (camera and world move in opposite directions)
-    def render(self, surf, offset=(0, 0)):
-        surf.blit(pygame.transform.flip(self.animation.img(), self.flip, False), (self.pos[0] - offset[0] + self.anim_offset[0], self.pos[1] - offset[1] + self.anim_offset[1]))
+    # shadow_surf gets the sprite's outline (drawn 1 pixel up and left of it since outlines are 1 pixel bigger on each side)
+    def render(self, surf, offset=(0, 0), shadow_surf=None):
+        render_pos = (self.pos[0] - offset[0] + self.anim_offset[0], self.pos[1] - offset[1] + self.anim_offset[1])
+        img = self.animation.img(self.flip)
+        surf.blit(img, render_pos)
+        if shadow_surf:
+            shadow_surf.blit(outline(img), (int(render_pos[0]) - 1, int(render_pos[1]) - 1))
 
 class Enemy(PhysicsEntity):
     def __init__(self, game, pos, size):
         super().__init__(game, 'enemy', pos, size)
 
-        self.walking = 0
+        self.spawn_pos = tuple(pos)
+
+    def reset(self):
+        # Puts the enemy back the way it spawned, so restarting a level can reuse it instead of building a new one
+        self.pos = list(self.spawn_pos)
+        self.velocity = [0, 0]
+        self.collisions = {'up': False, 'down': False, 'right': False, 'left': False}
+        self.flip = False
+        self.last_movement = [0, 0]
+        if self.action == 'idle':
+            self.animation.frame = 0
+            self.animation.done = False
+        else:
+            self.set_action('idle')
     
-    def render(self, surf: pygame.Surface, offset=(0, 0)):
-        super().render(surf, offset)
+    def render(self, surf: pygame.Surface, offset=(0, 0), shadow_surf=None):
+        super().render(surf, offset, shadow_surf)
         
+        gun = self.game.assets['gun']
         if self.flip:
-            surf.blit(pygame.transform.flip(self.game.assets['gun'], True, False), (self.rect().centerx - 4 - self.game.assets['gun'].get_width() - offset[0], self.rect().centery - offset[1]))
+            gun = flip(gun)
+            render_pos = (self.rect().centerx - 4 - gun.get_width() - offset[0], self.rect().centery - offset[1])
         else:
-            surf.blit(self.game.assets['gun'], (self.rect().centerx + 4 - offset[0], self.rect().centery - offset[1]))
+            render_pos = (self.rect().centerx + 4 - offset[0], self.rect().centery - offset[1])
+        surf.blit(gun, render_pos)
+        if shadow_surf:
+            shadow_surf.blit(outline(gun), (render_pos[0] - 1, render_pos[1] - 1))
 
     def update(self, tilemap, movement=(0, 0)):
-        if self.walking:
-            if tilemap.solid_check((self.rect().centerx + (-7 if self.flip else 7), self.pos[1] + 23)):
-                if (self.collisions['right'] or self.collisions['left']):
-                    self.flip = not self.flip
-                else:
-                    movement = (movement[0] - 0.5 if self.flip else 0.5, movement[1])
-            else:
-                self.flip = not self.flip
-            self.walking = max(0, self.walking-1)
-
-            if not self.walking:
-                dist = (self.game.player.pos[0] - self.pos[0], self.game.player.pos[1] - self.pos[1])
-                if abs(dist[1]) < 16:
-                    if (self.flip and dist[0] < 0):
-                        self.game.sfx['shoot'].play()
-                        self.game.projectiles.append([[self.rect().centerx - 7, self.rect().centery], -1.5, 0])
-                        for i in range(4):
-                            self.game.sparks.append(Spark(self.game.projectiles[-1][0], random.random() - 0.5 + math.pi, 2 + random.random()))
-                    if not self.flip and dist[0] > 0:
-                        self.game.projectiles.append([[self.rect().centerx + 7, self.rect().centery], 1.5, 0])
-                        for i in range(4):
-                            self.game.sparks.append(Spark(self.game.projectiles[-1][0], random.random() - 0.5, 2 + random.random()))
-
-        elif random.random() < 0.01:
-            self.walking = random.randint(30, 120)
-        
+        # Walking, turning at ledges and shooting are decided for all enemies at once by EnemyController, which passes the movement in
         super().update(tilemap, movement=movement)
 
         if movement[0] != 0:
@@ -124,20 +136,20 @@ class Enemy(PhysicsEntity):
         else:
             self.set_action('idle')
 
-        if abs(self.game.player.dashing) >= 50:
-            if self.rect().colliderect(self.game.player.rect()):
-                self.game.screenshake = max(16, self.game.screenshake)
-                self.game.sfx['hit'].play()
-                for i in range(30):
-                    angle = random.random() * math.pi * 2
-                    speed = random.random() * 5
-                    self.game.sparks.append(Spark(self.rect().center, angle, 2 + random.random()))
-                    self.game.particles.append(Particle(self.game, 'particle', self.rect().center, velocity=[math.cos(angle + math.pi) * speed * 0.5, math.sin(angle + math.pi) * speed * 0.5], frame=random.randint(0, 7)))
-                self.game.sparks.append(Spark(self.rect().center, 0, 5 + random.random()))
-                self.game.sparks.append(Spark(self.rect().center, math.pi, 5 + random.random()))
-
-                
-                return True
+        # The player is dashing through this enemy where it's just moved to (the spatial hash already has its new rect)
+        if abs(self.game.player.dashing) >= 50 and self.game.spatial_hash.rect(self).colliderect(self.game.player.rect()):
+            self.game.screenshake = max(16, self.game.screenshake)
+            self.game.sfx['hit'].play()
+            for i in range(30):
+                angle = random.random() * math.pi * 2
+                speed = random.random() * 5
+                self.game.sparks.spawn(self.rect().center, angle, 2 + random.random())
+                self.game.particles.spawn('particle', self.rect().center, velocity=(math.cos(angle + math.pi) * speed * 0.5, math.sin(angle + math.pi) * speed * 0.5), frame=random.randint(0, 7))
+            self.game.sparks.spawn(self.rect().center, 0, 5 + random.random())
+            self.game.sparks.spawn(self.rect().center, math.pi, 5 + random.random())
+
+            
+            return True
 
 class Player(PhysicsEntity):
     def __init__(self, game, pos, size):
@@ -183,7 +195,7 @@ class Player(PhysicsEntity):
                 angle = random.random() * math.pi * 2
                 speed = random.random() * 0.5 + 0.5
                 pvelocity = [math.cos(angle) * speed, math.sin(angle) * speed]
-                self.game.particles.append(Particle(self.game, 'particle', self.rect().center, pvelocity))
+                self.game.particles.spawn('particle', self.rect().center, pvelocity)
 
         if self.dashing > 0:
             self.dashing = max(0, self.dashing - 1)
@@ -195,16 +207,16 @@ class Player(PhysicsEntity):
             if abs(self.dashing) == 51:
                 self.velocity[0] *= 0.1
             pvelocity = [abs(self.dashing) / self.dashing * random.random() * 3, 0]
-            self.game.particles.append(Particle(self.game, 'particle', self.rect().center, pvelocity))
+            self.game.particles.spawn('particle', self.rect().center, pvelocity)
 
         if self.velocity[0] > 0:
             self.velocity[0] = max(self.velocity[0] - 0.1, 0)
         else:
             self.velocity[0] = min(self.velocity[0] + 0.1, 0)
     
-    def render(self, surf, offset=(0, 0)):
+    def render(self, surf, offset=(0, 0), shadow_surf=None):
         if abs(self.dashing) <= 50:
-            super().render(surf, offset)
+            super().render(surf, offset, shadow_surf)
 
     def jump(self):
         if self.wall_slide:
@@ -0,0 +1,129 @@
+import mmap
+import struct
+import sys
+from array import array
+
+# Binary level layout (little endian):
+#   header: magic, version, tile size, number of tile types
+#   string table: per type, a length byte then the UTF-8 name (a tile's type id is its index here)
+#   grid: x, y, width, height of the dense grid, then width * height packed tile ids (see tilemap.pack_tile), 2 bytes each
+#   sparse tiles: count, then (x, y, packed id) for tiles outside the dense grid
+#   offgrid tiles: count, then (x, y, packed id) with float positions
+MAGIC = b'PLVL'
+VERSION = 1
+HEADER = struct.Struct('<4sHHH')
+GRID_HEADER = struct.Struct('<iiII')
+COUNT = struct.Struct('<I')
+SPARSE_TILE = struct.Struct('<iiH')
+OFFGRID_TILE = struct.Struct('<ddH')
+
+def is_binary_level(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def save_level(tilemap, path):
+    offgrid = [OFFGRID_TILE.pack(tile['pos'][0], tile['pos'][1], (tilemap.type_id(tile['type']) + 1) << 8 | tile['variant']) for tile in tilemap.offgrid_tiles]
+    grid = array('H', tilemap.grid)
+    if sys.byteorder != 'little':
+        grid.byteswap()
+
+    data = bytearray(HEADER.pack(MAGIC, VERSION, tilemap.tile_size, len(tilemap.tile_types)))
+    for tile_type in tilemap.tile_types:
+        name = tile_type.encode('utf-8')
+        data += bytes([len(name)]) + name
+    if len(data) % 2:
+        data += b'\0' # Keeps the grid 2 byte aligned so it can be used straight from the mapped file
+    data += GRID_HEADER.pack(tilemap.grid_x, tilemap.grid_y, tilemap.grid_w, tilemap.grid_h)
+    data += grid.tobytes()
+    data += COUNT.pack(len(tilemap.sparse))
+    for loc, tile_id in tilemap.sparse.items():
+        data += SPARSE_TILE.pack(loc[0], loc[1], tile_id)
+    data += COUNT.pack(len(offgrid))
+    data += b''.join(offgrid)
+
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+def load_level(tilemap, path):
+    # The file is memory mapped copy-on-write and the grid is used in place, so only the pages that get touched are read in
+    # and edits to the grid never reach the file.
+    f = open(path, 'rb')
+    level_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    f.close()
+
+    magic, version, tile_size, type_count = HEADER.unpack_from(level_map, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(path + ' is not a version ' + str(VERSION) + ' binary level')
+    offset = HEADER.size
+    tile_types = []
+    for _ in range(type_count):
+        length = level_map[offset]
+        tile_types.append(level_map[offset + 1:offset + 1 + length].decode('utf-8'))
+        offset += 1 + length
+    offset += offset % 2
+
+    tilemap.tile_size = tile_size
+    tilemap.reset_types(tile_types)
+    tilemap.grid_x, tilemap.grid_y, tilemap.grid_w, tilemap.grid_h = GRID_HEADER.unpack_from(level_map, offset)
+    offset += GRID_HEADER.size
+    grid_bytes = tilemap.grid_w * tilemap.grid_h * 2
+    if sys.byteorder == 'little':
+        tilemap.grid = memoryview(level_map)[offset:offset + grid_bytes].cast('H')
+    else:
+        tilemap.grid = array('H', level_map[offset:offset + grid_bytes])
+        tilemap.grid.byteswap()
+    offset += grid_bytes
+
+    tilemap.sparse = {}
+    for _ in range(COUNT.unpack_from(level_map, offset)[0]):
+        x, y, tile_id = SPARSE_TILE.unpack_from(level_map, offset + COUNT.size + len(tilemap.sparse) * SPARSE_TILE.size)
+        tilemap.sparse[(x, y)] = tile_id
+    offset += COUNT.size + len(tilemap.sparse) * SPARSE_TILE.size
+
+    tilemap.offgrid_tiles = []
+    for x, y, tile_id in OFFGRID_TILE.iter_unpack(level_map[offset + COUNT.size:offset + COUNT.size + COUNT.unpack_from(level_map, offset)[0] * OFFGRID_TILE.size]):
+        tilemap.offgrid_tiles.append({'type': tile_types[(tile_id >> 8) - 1], 'variant': tile_id & 0xFF, 'pos': [x, y]})
+
+    tilemap.tile_count = tilemap.count_tiles()
+
+# Region file layout (little endian), one per region of a streamed world (see scripts/world.py), tile types come from the world's manifest:
+#   header: magic, version, region width and height in tiles
+#   grid: width * height packed tile ids, row major
+#   offgrid tiles: count, then (x, y, packed id) with float positions
+REGION_MAGIC = b'PRGN'
+REGION_VERSION = 1
+REGION_HEADER = struct.Struct('<4sHHH')
+
+def save_region(path, size, grid, offgrid):
+    # offgrid is a list of (x, y, packed id)
+    grid = array('H', grid)
+    if sys.byteorder != 'little':
+        grid.byteswap()
+    data = bytearray(REGION_HEADER.pack(REGION_MAGIC, REGION_VERSION, size, size))
+    data += grid.tobytes()
+    data += COUNT.pack(len(offgrid))
+    data += b''.join(OFFGRID_TILE.pack(x, y, tile_id) for x, y, tile_id in offgrid)
+
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+def load_region(path):
+    # Returns (grid, offgrid) as save_region took them. Only reads the file, so it's safe to run off the main thread.
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+
+    magic, version, width, height = REGION_HEADER.unpack_from(data, 0)
+    if magic != REGION_MAGIC or version != REGION_VERSION:
+        raise ValueError(path + ' is not a version ' + str(REGION_VERSION) + ' region')
+    offset = REGION_HEADER.size
+    grid = array('H', data[offset:offset + width * height * 2])
+    if sys.byteorder != 'little':
+        grid.byteswap()
+    offset += width * height * 2
+    count = COUNT.unpack_from(data, offset)[0]
+    offset += COUNT.size
+    offgrid = list(OFFGRID_TILE.iter_unpack(data[offset:offset + count * OFFGRID_TILE.size]))
+    return grid, offgrid
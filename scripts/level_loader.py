@@ -0,0 +1,81 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pygame
+
+from scripts.tilemap import Tilemap
+from scripts.world import StreamingTilemap, is_world
+
+FORMAT_PRIORITY = {'.json': 0, '.lvl': 1, '.world': 2} # Breaks ties between a map's formats saved at the same time, highest wins
+
+class LevelData:
+    # Everything load_level needs from a map file, built off the main thread
+    def __init__(self, tilemap, leaf_spawners, spawners):
+        self.tilemap = tilemap
+        self.leaf_spawners = leaf_spawners
+        self.spawners = spawners
+
+class LevelLoader:
+    def __init__(self, game, map_dir='data/maps'):
+        self.game = game
+        self.map_dir = map_dir
+
+        # The directory is only listed once. When a map is there in more than one format (convert_map.py writes a .lvl or a
+        # .world next to the JSON) the most recently saved one is used, so editing the JSON again isn't hidden by a stale conversion
+        candidates = {}
+        for name in sorted(os.listdir(map_dir)):
+            map_id, ext = os.path.splitext(name)
+            if ext in FORMAT_PRIORITY:
+                path = os.path.join(map_dir, name)
+                candidates.setdefault(map_id, []).append((self.saved_at(path), FORMAT_PRIORITY[ext], path))
+        self.paths = {}
+        for map_id, found in candidates.items():
+            found.sort(reverse=True)
+            self.paths[map_id] = found[0][2]
+            for saved_at, priority, path in found[1:]:
+                print('map ' + map_id + ': using ' + found[0][2] + ', ' + path + ' is older and ignored')
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='level-loader')
+        self.pending = {} # Maps being read in the background by map id
+
+    def __len__(self):
+        return len(self.paths)
+
+    def saved_at(self, path):
+        # A streamed world's manifest is written last when it's saved, so it dates the whole directory
+        return os.path.getmtime(os.path.join(path, 'world.json') if os.path.isdir(path) else path)
+
+    def path(self, map_id):
+        return self.paths[str(map_id)]
+
+    def read(self, map_id):
+        # Parses a map into its own tilemap, touching nothing the main thread is using so it's safe to run on the worker
+        # A streamed world only reads its manifest here, then every region once for the extracts (keeping the last few loaded)
+        path = self.path(map_id)
+        tilemap = (StreamingTilemap if is_world(path) else Tilemap)(self.game, self.game.tilemap.tile_size)
+        tilemap.load(path)
+
+        leaf_spawners = []
+        for tree in tilemap.extract([('large_decor', 2)], keep=True):
+            leaf_spawners.append(pygame.Rect(4 + tree['pos'][0], 4 + tree['pos'][1], 23, 13))
+        spawners = tilemap.extract([('spawners', 0), ('spawners', 1)])
+        tilemap.build_collision()
+        tilemap.build_offgrid_buckets()
+
+        return LevelData(tilemap, leaf_spawners, spawners)
+
+    def prefetch(self, map_id):
+        # Starts reading a map in the background so get() can hand it over without waiting
+        if str(map_id) in self.paths and map_id not in self.pending:
+            self.pending[map_id] = self.executor.submit(self.read, map_id)
+
+    def get(self, map_id):
+        # A prefetched map is handed over once, loading the same map again reads it again
+        future = self.pending.pop(map_id, None)
+        if future:
+            return future.result()
+        return self.read(map_id)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending = {}
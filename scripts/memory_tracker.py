@@ -0,0 +1,92 @@
+import gc
+import sys
+import time
+import tracemalloc
+
+ALLOC_BUDGET = 64 * 1024 # Bytes a frame may allocate before it's flagged
+TIME_BUDGET = 1000 / 60 # Milliseconds a frame may take before it's flagged
+
+class MemoryTracker:
+    # Opt-in allocation and GC tracking, hooked into the Profiler's stages. tracemalloc slows everything down, so this is only
+    # ever switched on to look for churn (benchmark.py --memory, or F5 in game), never left running.
+    # Per stage it records the bytes allocated (the traced peak above where the stage started, so short lived objects count)
+    # and the change in live memory blocks. GC pauses are timed through gc.callbacks and charged to the stage they interrupt.
+    def __init__(self, alloc_budget=ALLOC_BUDGET, time_budget=TIME_BUDGET):
+        self.alloc_budget = alloc_budget
+        self.time_budget = time_budget
+        self.active = False
+        self.levels = {} # Level -> report dict, see begin_level()
+        self.report_level = None
+        self.current = None
+        self.stage_memory = 0
+        self.stage_blocks = 0
+        self.gc_start = 0
+        self.frame_allocated = 0
+        self.frame_gc = 0
+
+    def start(self):
+        if not self.active:
+            tracemalloc.start()
+            gc.callbacks.append(self.on_gc)
+            self.active = True
+
+    def stop(self):
+        if self.active:
+            gc.callbacks.remove(self.on_gc)
+            tracemalloc.stop()
+            self.active = False
+            self.current = None
+
+    def begin_level(self, level):
+        # Everything from here on is reported under level (loading the same level again carries on its report)
+        self.report_level = self.levels.setdefault(level, {'frames': 0, 'allocated': {}, 'blocks': {}, 'gc_pauses': {}, 'gc_ms': {}, 'flagged': []})
+
+    def stage(self, name):
+        if not self.active:
+            return
+        memory, peak = tracemalloc.get_traced_memory()
+        blocks = sys.getallocatedblocks()
+        if self.current and self.report_level:
+            allocated = max(0, peak - self.stage_memory)
+            self.report_level['allocated'][self.current] = self.report_level['allocated'].get(self.current, 0) + allocated
+            self.report_level['blocks'][self.current] = self.report_level['blocks'].get(self.current, 0) + blocks - self.stage_blocks
+            self.frame_allocated += allocated
+        self.current = name
+        tracemalloc.reset_peak()
+        self.stage_memory = tracemalloc.get_traced_memory()[0]
+        self.stage_blocks = sys.getallocatedblocks()
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+        elif self.report_level and self.current:
+            pause = (time.perf_counter() - self.gc_start) * 1000
+            stage = self.current + ' gen' + str(info['generation'])
+            self.report_level['gc_pauses'][stage] = self.report_level['gc_pauses'].get(stage, 0) + 1
+            self.report_level['gc_ms'][stage] = self.report_level['gc_ms'].get(stage, 0) + pause
+            self.frame_gc += pause
+
+    def end_frame(self, frame_ms):
+        # Called by the Profiler after the frame's last stage closed, with how long the frame took
+        if not self.active or not self.report_level:
+            return
+        if self.frame_allocated > self.alloc_budget or frame_ms > self.time_budget:
+            self.report_level['flagged'].append((self.report_level['frames'], self.frame_allocated, frame_ms, self.frame_gc))
+        self.report_level['frames'] += 1
+        self.frame_allocated = 0
+        self.frame_gc = 0
+
+    def report(self):
+        # Text summary for every level: allocation per frame by stage, GC pauses by stage and generation, and the over budget frames
+        lines = []
+        for level, report in self.levels.items():
+            frames = max(1, report['frames'])
+            lines.append('level ' + str(level) + ': ' + str(report['frames']) + ' frames, ' + format(sum(report['allocated'].values()) / frames / 1024, '.1f') + ' KiB allocated per frame')
+            for stage, allocated in sorted(report['allocated'].items(), key=lambda item: -item[1]):
+                lines.append('    ' + stage.ljust(12) + format(allocated / frames / 1024, '9.2f') + ' KiB/frame ' + format(report['blocks'][stage] / frames, '+9.1f') + ' blocks/frame')
+            for stage, count in sorted(report['gc_pauses'].items(), key=lambda item: -report['gc_ms'][item[0]]):
+                lines.append('    gc in ' + stage.ljust(17) + str(count).rjust(5) + ' pauses ' + format(report['gc_ms'][stage], '8.2f') + ' ms')
+            lines.append('    ' + str(len(report['flagged'])) + ' frames over budget (' + format(self.alloc_budget / 1024, '.0f') + ' KiB or ' + format(self.time_budget, '.1f') + ' ms)')
+            for frame, allocated, frame_ms, gc_ms in sorted(report['flagged'], key=lambda flagged: -flagged[2])[:5]:
+                lines.append('        frame ' + str(frame).ljust(6) + format(allocated / 1024, '8.1f') + ' KiB ' + format(frame_ms, '8.2f') + ' ms ' + format(gc_ms, '7.2f') + ' ms in gc')
+        return '\n'.join(lines)
@@ -1,24 +1,95 @@
-class Particle:
-    def __init__(self, game, p_type, pos, velocity=[0, 0], frame=0) -> None:
-        self.game = game
-        self.type = p_type
-        self.pos = list(pos)
-        self.velocity = list(velocity)
-        self.animation = self.game.assets['particle/' + p_type].copy()
-        self.animation.frame = frame
-    
-    def update(self):
-        kill = False
-        if self.animation.done:
-            kill = True
-        self.pos[0] += self.velocity[0]
-        self.pos[1] += self.velocity[1]
-
-        self.animation.update()
-
-        return kill
-    
-    def render(self, surf, offset=(0, 0)):
-        img = self.animation.img()
-        surf.blit(img, (self.pos[0] - offset[0] - img.get_width() // 2, self.pos[1] - offset[1] - img.get_height() // 2))
-        
\ No newline at end of file
+import numpy as np
+
+LEAF_SWAY_SPEED = 0.035
+LEAF_SWAY_AMOUNT = 0.3
+
+class ParticleSystem:
+    # Every live particle is a row across a handful of NumPy arrays (struct of arrays) instead of its own object with its own Animation,
+    # so a frame is a few vectorized operations no matter how many particles there are.
+    # Particles play their animation once and die on its last frame, like the non-looping particle Animations they are built from.
+    def __init__(self, animations, capacity=1024):
+        self.types = list(animations) # Type ids are indexes into this
+        self.type_ids = {p_type: i for i, p_type in enumerate(self.types)}
+
+        # All frames of every type live in one flat list, a particle's image is images[img_base[type] + frame // img_dur[type]]
+        self.images = []
+        img_base, img_dur, last_frame = [], [], []
+        for p_type in self.types:
+            animation = animations[p_type]
+            img_base.append(len(self.images))
+            img_dur.append(animation.img_duration)
+            last_frame.append(animation.img_duration * len(animation.images) - 1)
+            self.images += animation.images
+        self.img_base = np.array(img_base)
+        self.img_dur = np.array(img_dur)
+        self.last_frame = np.array(last_frame)
+        self.half_sizes = np.array([(img.get_width() // 2, img.get_height() // 2) for img in self.images])
+        self.max_size = max(max(img.get_size()) for img in self.images)
+        self.leaf_id = self.type_ids.get('leaf', -1)
+
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.velocity = np.zeros((capacity, 2))
+        self.frame = np.zeros(capacity, dtype=np.int64)
+        self.type = np.zeros(capacity, dtype=np.int64)
+        self.done = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def grow(self, needed):
+        capacity = len(self.frame)
+        while capacity < needed:
+            capacity *= 2
+        for name in ('pos', 'velocity', 'frame', 'type', 'done'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def spawn(self, p_type, pos, velocity=(0, 0), frame=0):
+        if self.count == len(self.frame):
+            self.grow(self.count + 1)
+        i = self.count
+        self.pos[i] = pos
+        self.velocity[i] = velocity
+        self.frame[i] = frame
+        self.type[i] = self.type_ids[p_type]
+        self.done[i] = False
+        self.count += 1
+
+    def update(self, surf, offset=(0, 0)):
+        # Moves, animates and draws every particle, then drops the ones whose animation had already finished (same order as the old per particle update)
+        n = self.count
+        if not n:
+            return
+        pos = self.pos[:n]
+        frame = self.frame[:n]
+        p_type = self.type[:n]
+
+        kill = self.done[:n].copy()
+        pos += self.velocity[:n]
+        last_frame = self.last_frame[p_type]
+        np.minimum(frame + 1, last_frame, out=frame)
+        self.done[:n] = frame >= last_frame
+
+        # Only particles that can overlap the screen get blitted, with a single blits() call
+        img_index = self.img_base[p_type] + frame // self.img_dur[p_type]
+        render_pos = pos - offset - self.half_sizes[img_index]
+        visible = (render_pos[:, 0] > -self.max_size) & (render_pos[:, 0] < surf.get_width()) & (render_pos[:, 1] > -self.max_size) & (render_pos[:, 1] < surf.get_height())
+        render_pos = render_pos[visible]
+        surf.blits(zip(map(self.images.__getitem__, img_index[visible].tolist()), zip(render_pos[:, 0].tolist(), render_pos[:, 1].tolist())), doreturn=False)
+
+        # Leaves sway from side to side as they fall
+        leaves = p_type == self.leaf_id
+        pos[leaves, 0] += np.sin(frame[leaves] * LEAF_SWAY_SPEED) * LEAF_SWAY_AMOUNT
+
+        if kill.any():
+            alive = ~kill
+            self.count = int(alive.sum())
+            for name in ('pos', 'velocity', 'frame', 'type', 'done'):
+                array = getattr(self, name)
+                array[:self.count] = array[:n][alive]
@@ -0,0 +1,153 @@
+import time
+import csv
+import json
+from collections import deque
+
+import numpy as np
+import pygame
+
+ROLLING_FRAMES = 120 # How many recent frames the overlay's averages and p99s cover
+OVERLAY_REFRESH = 15 # The overlay text is only re-rendered every this many frames
+
+class Profiler:
+    # Times the stages of a frame. Call stage(name) at each boundary (it closes the previous stage) and end_frame() once per frame.
+    # When disabled every call returns straight away, so it can stay wired into the main loop.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.totals = {} # Seconds spent in each stage since the last reset
+        self.frames = 0
+        self.current = None
+        self.stage_start = 0
+
+        self.frame_stages = [] # (stage, start, seconds) for the frame in progress
+        self.counts = {} # Counters (entities, particles...) for the frame in progress, set through count()
+        self.history = deque(maxlen=ROLLING_FRAMES) # ({stage: seconds}, counts) for the most recent frames
+        self.recording = False
+        self.samples = [] # (frame_stages, counts) for every frame since start_recording(), for the exports
+        self.memory = None # A MemoryTracker to tell about stage boundaries too, when allocations are being tracked
+
+    def stage(self, name):
+        if self.enabled:
+            now = time.perf_counter()
+            if self.current:
+                self.totals[self.current] = self.totals.get(self.current, 0) + now - self.stage_start
+                self.frame_stages.append((self.current, self.stage_start, now - self.stage_start))
+            self.current = name
+            self.stage_start = now
+            if self.memory:
+                self.memory.stage(name)
+                self.stage_start = time.perf_counter() # The tracker's own work isn't part of the stage
+
+    def count(self, name, value):
+        if self.enabled:
+            self.counts[name] = value
+
+    def end_frame(self):
+        if self.enabled:
+            self.stage(None)
+            self.frames += 1
+            self.history.append(({stage: seconds for stage, start, seconds in self.frame_stages}, self.counts))
+            if self.memory:
+                self.memory.end_frame(sum(seconds for stage, start, seconds in self.frame_stages) * 1000)
+            if self.recording:
+                self.samples.append((self.frame_stages, self.counts))
+            self.frame_stages = []
+            self.counts = {}
+
+    def reset(self):
+        self.totals = {}
+        self.frames = 0
+        self.current = None
+        self.frame_stages = []
+        self.counts = {}
+        self.history.clear()
+
+    def start_recording(self):
+        self.recording = True
+        self.samples = []
+
+    def stop_recording(self):
+        self.recording = False
+
+    def update_enabled(self, visible):
+        # Timing is needed while anything uses it: the overlay (visible), a recording, or a MemoryTracker hooked into the stages
+        self.enabled = visible or self.recording or self.memory is not None
+
+    def rolling_stats(self):
+        # (stage, average ms, p99 ms) over the recent frames, slowest stages first, with the whole frame as 'total'
+        stages = list(dict.fromkeys(stage for stage_times, counts in self.history for stage in stage_times))
+        if not stages:
+            return []
+        ms = np.array([[stage_times.get(stage, 0) for stage in stages] for stage_times, counts in self.history]) * 1000
+        ms = np.column_stack((ms, ms.sum(axis=1)))
+        stats = list(zip(stages + ['total'], ms.mean(axis=0).tolist(), np.percentile(ms, 99, axis=0).tolist()))
+        return sorted(stats, key=lambda stat: -stat[1])
+
+    def stage_names(self):
+        return list(dict.fromkeys(stage for frame_stages, counts in self.samples for stage, start, seconds in frame_stages))
+
+    def export_csv(self, path):
+        # One row per recorded frame: milliseconds spent in each stage, the frame total, then the counters
+        stages = self.stage_names()
+        counters = list(dict.fromkeys(name for frame_stages, counts in self.samples for name in counts))
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame'] + [stage + '_ms' for stage in stages] + ['total_ms'] + counters)
+            for frame, (frame_stages, counts) in enumerate(self.samples):
+                stage_ms = {stage: 0 for stage in stages}
+                for stage, start, seconds in frame_stages:
+                    stage_ms[stage] += seconds * 1000
+                writer.writerow([frame] + [format(stage_ms[stage], '.4f') for stage in stages] + [format(sum(stage_ms.values()), '.4f')] + [counts.get(name, '') for name in counters])
+
+    def export_trace(self, path):
+        # Chrome trace event format (open it in chrome://tracing or Perfetto): every stage as a complete event, counters as counter events
+        starts = [frame_stages[0][1] for frame_stages, counts in self.samples if frame_stages]
+        origin = starts[0] if starts else 0
+        events = []
+        for frame, (frame_stages, counts) in enumerate(self.samples):
+            for stage, start, seconds in frame_stages:
+                events.append({'name': stage, 'cat': 'frame', 'ph': 'X', 'ts': (start - origin) * 1e6, 'dur': seconds * 1e6, 'pid': 0, 'tid': 0, 'args': {'frame': frame}})
+            if counts and frame_stages:
+                events.append({'name': 'counts', 'ph': 'C', 'ts': (frame_stages[0][1] - origin) * 1e6, 'pid': 0, 'tid': 0, 'args': counts})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+class ProfilerOverlay:
+    # Draws the profiler's rolling stats in the corner of the screen. The text is rendered into a cached surface that's only
+    # redrawn every OVERLAY_REFRESH frames, so showing it costs one blit most frames.
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.visible = False
+        self.font = None
+        self.surf = None
+        self.age = OVERLAY_REFRESH
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.profiler.update_enabled(self.visible)
+        self.age = OVERLAY_REFRESH
+
+    def refresh(self):
+        if not self.font:
+            self.font = pygame.font.Font(None, 16)
+        rows = [('stage', 'avg ms', 'p99 ms')]
+        for stage, avg, p99 in self.profiler.rolling_stats():
+            rows.append((stage, format(avg, '.3f'), format(p99, '.3f')))
+        if self.profiler.history:
+            rows.append((' '.join(name + ' ' + str(value) for name, value in self.profiler.history[-1][1].items()),))
+        if self.profiler.recording:
+            rows.append(('recording ' + str(len(self.profiler.samples)) + ' frames',))
+        line_height = self.font.get_linesize()
+        self.surf = pygame.Surface((260, line_height * len(rows) + 4), pygame.SRCALPHA)
+        self.surf.fill((0, 0, 0, 160))
+        for i, row in enumerate(rows):
+            for column, text in zip((4, 110, 170), row): # Each column gets its own x so the numbers line up
+                self.surf.blit(self.font.render(text, True, (255, 255, 255)), (column, 2 + i * line_height))
+
+    def render(self, surf):
+        if self.visible:
+            self.age += 1
+            if self.age >= OVERLAY_REFRESH:
+                self.refresh()
+                self.age = 0
+            surf.blit(self.surf, (0, 0))
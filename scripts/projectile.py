@@ -0,0 +1,108 @@
+import math
+import numpy as np
+from scripts.utils import outline
+
+PROJECTILE_LIFETIME = 360 # Frames before a projectile that hit nothing disappears
+PROJECTILE_SPEED = 1.5 # Pixels per frame
+
+class ProjectileSystem:
+    # Projectiles live in fixed slots of pre-allocated NumPy arrays. Freed slots go on a free list and get reused,
+    # so spawning and removing never shuffles other projectiles around, and a frame updates every live slot at once.
+    def __init__(self, img, capacity=256):
+        self.img = img
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.velocity = np.zeros(capacity) # Projectiles only fly horizontally
+        self.timer = np.zeros(capacity, dtype=np.int64)
+        self.hit_timer = np.zeros(capacity, dtype=np.int64) # The frame the projectile will be inside a wall, -1 if it never reaches one
+        self.active = np.zeros(capacity, dtype=bool)
+        self.free = list(range(capacity - 1, -1, -1)) # Popped from the end, so slot 0 is used first
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.active[:] = False
+        self.free = list(range(len(self.active) - 1, -1, -1))
+        self.count = 0
+
+    def grow(self):
+        capacity = len(self.active)
+        for name in ('pos', 'velocity', 'timer', 'hit_timer', 'active'):
+            old = getattr(self, name)
+            new = np.zeros((capacity * 2,) + old.shape[1:], dtype=old.dtype)
+            new[:capacity] = old
+            setattr(self, name, new)
+        self.free = list(range(capacity * 2 - 1, capacity - 1, -1)) + self.free
+
+    def spawn(self, pos, velocity, tilemap):
+        if not self.free:
+            self.grow()
+        i = self.free.pop()
+        self.pos[i] = pos
+        self.velocity[i] = velocity
+        self.timer[i] = 0
+        self.hit_timer[i] = self.impact_frame(pos, velocity, tilemap)
+        self.active[i] = True
+        self.count += 1
+
+    def impact_frame(self, pos, velocity, tilemap):
+        # Projectiles fly in a straight line through a map that doesn't change under them, so the frame one ends up inside a wall
+        # is worked out once here with a raycast instead of checking the map every frame. Frame n has moved n * velocity, and a
+        # wall is hit once the position is inside a solid tile the same way solid_check sees it.
+        first = (pos[0] + velocity, pos[1])
+        if tilemap.solid_check(first):
+            return 1
+        dist = tilemap.raycast(first, (velocity, 0), (PROJECTILE_LIFETIME + 1) * abs(velocity))
+        if dist is None:
+            return -1
+        if velocity > 0:
+            return 1 + math.ceil(dist / velocity) # Reaching the tile's left edge is already inside it
+        return 1 + math.floor(dist / -velocity) + 1 # Has to get past the tile's right edge
+
+    def kill(self, slots):
+        self.active[slots] = False
+        self.free += slots.tolist()
+        self.count -= len(slots)
+
+    def update(self, spatial_hash, targets, surf, offset=(0, 0), shadow_surf=None):
+        # Moves and draws every projectile (and its outline onto shadow_surf), then removes the ones that hit a wall, ran out of time or hit one of targets (objects in spatial_hash).
+        # Returns (wall hits, target hits) as lists of (pos, velocity) and (pos, target) so the caller can add effects.
+        if not self.count:
+            return [], []
+        slots = np.flatnonzero(self.active)
+        self.pos[slots, 0] += self.velocity[slots]
+        self.timer[slots] += 1
+        pos = self.pos[slots]
+
+        render_pos = pos - offset - (self.img.get_width() / 2, self.img.get_height() / 2)
+        surf.blits(zip([self.img] * len(slots), zip(render_pos[:, 0].tolist(), render_pos[:, 1].tolist())), doreturn=False)
+        if shadow_surf:
+            shadow_pos = np.trunc(render_pos) - 1
+            shadow_surf.blits(zip([outline(self.img)] * len(slots), zip(shadow_pos[:, 0].tolist(), shadow_pos[:, 1].tolist())), doreturn=False)
+
+        # Wall hits were worked out when each projectile was fired
+        in_wall = self.timer[slots] == self.hit_timer[slots]
+        wall_hits = [(p, v) for p, v in zip(pos[in_wall].tolist(), self.velocity[slots[in_wall]].tolist())]
+        dead = in_wall | (self.timer[slots] > PROJECTILE_LIFETIME)
+
+        target_hits = []
+        live = np.flatnonzero(~dead)
+        if len(targets) and len(live):
+            # Broad phase: group live projectiles by spatial hash cell, only cells that hold a target need the exact point-in-rect test
+            cells, inverse, counts = np.unique(np.floor(pos[live] / spatial_hash.cell_size).astype(np.int64), axis=0, return_inverse=True, return_counts=True)
+            order = np.argsort(inverse.ravel(), kind='stable')
+            starts = np.cumsum(counts) - counts
+            for cell, start, count in zip(map(tuple, cells.tolist()), starts.tolist(), counts.tolist()):
+                for target in spatial_hash.cells.get(cell, ()):
+                    if target not in targets:
+                        continue
+                    rect = spatial_hash.rect(target)
+                    members = live[order[start:start + count]]
+                    members = members[~dead[members]]
+                    inside = (pos[members, 0] >= rect.left) & (pos[members, 0] < rect.right) & (pos[members, 1] >= rect.top) & (pos[members, 1] < rect.bottom)
+                    target_hits += [(p, target) for p in pos[members[inside]].tolist()]
+                    dead[members[inside]] = True
+
+        self.kill(slots[dead])
+        return wall_hits, target_hits
@@ -1,25 +1,96 @@
 import math
+import numpy as np
 import pygame
+from scripts.utils import OUTLINE_OFFSETS
 
-class Spark:
-    def __init__(self, pos, angle, speed):
-        self.pos = list(pos)
-        self.angle = angle
-        self.speed = speed
-    
-    def update(self):
-        self.pos[0] += math.cos(self.angle) * self.speed
-        self.pos[1] += math.sin(self.angle) * self.speed
-
-        self.speed = max(0, self.speed - 0.1)
-        return not self.speed
-
-    def render(self, surf, offset=(0, 0)):
-        render_points = [
-            (self.pos[0] + math.cos(self.angle) * self.speed * 3 - offset[0], self.pos[1] + math.sin(self.angle) * self.speed * 3 - offset[1]),
-            (self.pos[0] + math.cos(self.angle + math.pi * 0.5) * self.speed * 0.5 - offset[0], self.pos[1] + math.sin(self.angle + math.pi * 0.5) * self.speed * 0.5 - offset[1]),
-            (self.pos[0] + math.cos(self.angle + math.pi) * self.speed * 3 - offset[0], self.pos[1] + math.sin(self.angle + math.pi) * self.speed * 3 - offset[1]),
-            (self.pos[0] + math.cos(self.angle - math.pi * 0.5) * self.speed * 0.5 - offset[0], self.pos[1] + math.sin(self.angle - math.pi * 0.5) * self.speed * 0.5 - offset[1])
-        ]
-
-        pygame.draw.polygon(surf, (255, 255, 255), render_points)
\ No newline at end of file
+# The diamond is drawn from 4 points around the spark: (turn from its angle, length as a multiple of its speed)
+SPARK_SHAPE = [(0, 3), (math.pi * 0.5, 0.5), (math.pi, 3), (-math.pi * 0.5, 0.5)]
+SPARK_LENGTHS = np.array([length for turn, length in SPARK_SHAPE])
+MERGE_DISTANCE = 4 # Sparks drawn this close (in pixels) get their outline blitted together, groups further apart than this never share outline pixels
+
+class SparkSystem:
+    # Sparks as rows in NumPy arrays. A spark's angle never changes, so every cos/sin it needs is worked out once when it spawns,
+    # then each frame moves all sparks and builds every diamond's 4 points in a handful of array operations.
+    def __init__(self, capacity=256):
+        self.layer = None # Made once for the surface size, the sparks' silhouettes are drawn here so their outline can be blitted from it
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.speed = np.zeros(capacity)
+        self.direction = np.zeros((capacity, 2)) # cos/sin of the angle
+        self.shape_x = np.zeros((capacity, 4)) # cos/sin of the angle turned to each point of the diamond
+        self.shape_y = np.zeros((capacity, 4))
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def grow(self, needed):
+        capacity = len(self.speed)
+        while capacity < needed:
+            capacity *= 2
+        for name in ('pos', 'speed', 'direction', 'shape_x', 'shape_y'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:])
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def spawn(self, pos, angle, speed):
+        if self.count == len(self.speed):
+            self.grow(self.count + 1)
+        i = self.count
+        self.pos[i] = pos
+        self.speed[i] = speed
+        self.direction[i] = (math.cos(angle), math.sin(angle))
+        self.shape_x[i] = [math.cos(angle + turn) for turn, length in SPARK_SHAPE]
+        self.shape_y[i] = [math.sin(angle + turn) for turn, length in SPARK_SHAPE]
+        self.count += 1
+
+    def update(self, surf, offset=(0, 0), shadow_surf=None):
+        # Moves, slows and draws every spark (and their outline onto shadow_surf), then drops the ones that have stopped
+        n = self.count
+        if not n:
+            return
+        speed = self.speed[:n]
+        pos = self.pos[:n]
+        pos += self.direction[:n] * speed[:, None]
+        np.maximum(speed - 0.1, 0, out=speed)
+
+        points_x = pos[:, 0, None] + self.shape_x[:n] * speed[:, None] * SPARK_LENGTHS - offset[0]
+        points_y = pos[:, 1, None] + self.shape_y[:n] * speed[:, None] * SPARK_LENGTHS - offset[1]
+        # Sparks whose diamond is completely off screen (with a couple of pixels to spare for rounding) aren't drawn
+        visible = (points_x.max(1) > -2) & (points_x.min(1) < surf.get_width() + 2) & (points_y.max(1) > -2) & (points_y.min(1) < surf.get_height() + 2)
+        if not shadow_surf:
+            for xs, ys in zip(points_x[visible].tolist(), points_y[visible].tolist()):
+                pygame.draw.polygon(surf, (255, 255, 255), list(zip(xs, ys)))
+        elif visible.any():
+            if not self.layer or self.layer.get_size() != surf.get_size():
+                self.layer = pygame.Surface(surf.get_size(), pygame.SRCALPHA)
+            rects = []
+            for xs, ys in zip(points_x[visible].tolist(), points_y[visible].tolist()):
+                points = list(zip(xs, ys))
+                pygame.draw.polygon(surf, (255, 255, 255), points)
+                drawn = pygame.draw.polygon(self.layer, (0, 0, 0, 180), points)
+                if drawn.width and drawn.height:
+                    # Sparks from the same burst overlap, so nearby rects are merged and their outline blitted in one go
+                    touching = drawn.inflate(MERGE_DISTANCE * 2, MERGE_DISTANCE * 2).collidelistall(rects)
+                    while touching:
+                        for i in reversed(touching):
+                            drawn.union_ip(rects.pop(i))
+                        touching = drawn.inflate(MERGE_DISTANCE * 2, MERGE_DISTANCE * 2).collidelistall(rects)
+                    rects.append(drawn)
+            # The outline is the silhouette blitted 1 pixel off in each direction, the same as make_outline (give or take rounding)
+            # but only over each group's rect, so the cost follows the sparks rather than how far apart they are
+            for rect in rects:
+                for offset in OUTLINE_OFFSETS:
+                    shadow_surf.blit(self.layer, (rect.left + offset[0], rect.top + offset[1]), rect)
+                self.layer.fill((0, 0, 0, 0), rect)
+
+        kill = speed == 0
+        if kill.any():
+            alive = ~kill
+            self.count = int(alive.sum())
+            for name in ('pos', 'speed', 'direction', 'shape_x', 'shape_y'):
+                array = getattr(self, name)
+                array[:self.count] = array[:n][alive]
@@ -0,0 +1,71 @@
+import pygame
+
+class SpatialHash:
+    # Uniform grid of cell_size pixel cells, each holding the objects whose rect touches it.
+    # Objects are (re)registered with update() whenever they move, and queries only look at the cells they cover.
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells = {} # (cell x, cell y) -> set of objects
+        self.entries = {} # object -> (rect, cell range it's registered in)
+
+    def cell_range(self, rect):
+        return (int(rect.left // self.cell_size), int(rect.top // self.cell_size), int((rect.right - 1) // self.cell_size), int((rect.bottom - 1) // self.cell_size))
+
+    def update(self, obj, rect):
+        # Inserts obj or moves it to rect, only touching the cell sets if the rect crossed into different cells
+        cell_range = self.cell_range(rect)
+        if obj in self.entries:
+            old_range = self.entries[obj][1]
+            if old_range == cell_range:
+                self.entries[obj] = (pygame.Rect(rect), cell_range)
+                return
+            self.remove(obj)
+        self.entries[obj] = (pygame.Rect(rect), cell_range)
+        for cx in range(cell_range[0], cell_range[2] + 1):
+            for cy in range(cell_range[1], cell_range[3] + 1):
+                self.cells.setdefault((cx, cy), set()).add(obj)
+
+    def remove(self, obj):
+        if obj not in self.entries:
+            return
+        cell_range = self.entries.pop(obj)[1]
+        for cx in range(cell_range[0], cell_range[2] + 1):
+            for cy in range(cell_range[1], cell_range[3] + 1):
+                cell = self.cells[(cx, cy)]
+                cell.discard(obj)
+                if not cell:
+                    del self.cells[(cx, cy)]
+
+    def clear(self):
+        self.cells = {}
+        self.entries = {}
+
+    def rect(self, obj):
+        return self.entries[obj][0]
+
+    def nearby(self, rect):
+        # Everything registered in the cells rect covers (a superset of what actually overlaps it)
+        found = set()
+        cell_range = self.cell_range(rect)
+        for cx in range(cell_range[0], cell_range[2] + 1):
+            for cy in range(cell_range[1], cell_range[3] + 1):
+                if (cx, cy) in self.cells:
+                    found |= self.cells[(cx, cy)]
+        return found
+
+    def query_rect(self, rect, kind=object):
+        # Objects (optionally only instances of kind) whose rect overlaps rect
+        rect = pygame.Rect(rect)
+        return {obj for obj in self.nearby(rect) if isinstance(obj, kind) and self.entries[obj][0].colliderect(rect)}
+
+    def query_radius(self, pos, radius, kind=object):
+        # Objects (optionally only instances of kind) whose rect has a point within radius of pos
+        found = set()
+        for obj in self.nearby(pygame.Rect(pos[0] - radius, pos[1] - radius, radius * 2 + 1, radius * 2 + 1)):
+            if isinstance(obj, kind):
+                rect = self.entries[obj][0]
+                dx = max(rect.left - pos[0], 0, pos[0] - rect.right)
+                dy = max(rect.top - pos[1], 0, pos[1] - rect.bottom)
+                if dx * dx + dy * dy <= radius * radius:
+                    found.add(obj)
+        return found
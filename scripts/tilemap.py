@@ -1,5 +1,11 @@
+import math
+import numpy as np
 import pygame
 import json
+from scripts.utils import make_outline
+from scripts.level_format import is_binary_level, save_level, load_level
+from array import array
+from collections.abc import MutableMapping
 
 AUTOTILE_MAP = {
     tuple(sorted([(1, 0), (0, 1)])): 0,
@@ -13,98 +19,568 @@ AUTOTILE_MAP = {
     tuple(sorted([(1, 0), (-1, 0), (0, 1), (0, -1)])): 8,
 }
 
+# AUTOTILE_MAP as a table indexed by a 4 bit mask of which neighbours are the same type, -1 where the tile is left alone
+NEIGHBOUR_BITS = {(1, 0): 1, (-1, 0): 2, (0, -1): 4, (0, 1): 8}
+AUTOTILE_MASKS = np.full(16, -1, dtype=np.int16)
+for neighbours, variant in AUTOTILE_MAP.items():
+    AUTOTILE_MASKS[sum(NEIGHBOUR_BITS[shift] for shift in neighbours)] = variant
+
+CHUNK_SIZE = 16 # Chunks are CHUNK_SIZE x CHUNK_SIZE tiles, pre-rendered into a single surface
+
 NEIGHBOUR_OFFSETS = [(-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0), (0 ,0), (-1, 1), (0, 1), (1, 1)] # The 9 tiles around the player
 PHYSICS_TILES = {'grass', 'stone'}
 AUTOTILE_TYPES = {'grass', 'stone'}
+SPARSE_LIMIT = 256 # Once this many more tiles live outside the dense grid than compact() left there, the grid is rebuilt around them
+GRID_SLACK = 16 # The dense grid may have this many cells per tile inside it (the maps here use 2 to 5), past that it's shrunk
+GRID_MIN_AREA = 64 * 64 # Grids up to this many cells are never shrunk, however few tiles they hold
+
+def grid_bounds(tiles):
+    # (x, y, w, h) for the dense grid around (x, y, tile id) tiles: their bounding box, shrunk while it has more than GRID_SLACK
+    # cells per tile in it. Each step leaves out the tiles past some column or row, picked by how many cells that frees per
+    # tile left out: stray tiles far from the rest free a lot each, so they go first and stay in the sparse dict. Of the cuts
+    # on the best edge the deepest one freeing at least half as much per tile is taken, so thinly scattered tiles go in a few steps.
+    if not tiles:
+        return 0, 0, 0, 0
+    xs = np.array([tile[0] for tile in tiles])
+    ys = np.array([tile[1] for tile in tiles])
+    while True:
+        x0, x1, y0, y1 = int(xs.min()), int(xs.max()), int(ys.min()), int(ys.max())
+        area = (x1 - x0 + 1) * (y1 - y0 + 1)
+        if area <= max(GRID_MIN_AREA, GRID_SLACK * len(xs)):
+            return x0, y0, x1 - x0 + 1, y1 - y0 + 1
+        best = None
+        for values, span in ((xs, y1 - y0 + 1), (ys, x1 - x0 + 1)):
+            ordered = np.sort(values)
+            cuts = np.flatnonzero(ordered[1:] != ordered[:-1]) + 1 # Leaving out the first cut tiles in order drops whole columns/rows
+            if not len(cuts):
+                continue
+            low = (ordered[cuts] - ordered[0]) * span / cuts # Cells freed per tile by leaving out everything before ordered[cut]
+            high = (ordered[-1] - ordered[cuts - 1]) * span / (len(values) - cuts) # And everything from ordered[cut] on
+            if best is None or low.max() > best[0]:
+                best = (low.max(), values < ordered[cuts[np.flatnonzero(low >= low.max() / 2)[-1]]])
+            if high.max() > best[0]:
+                best = (high.max(), values >= ordered[cuts[np.flatnonzero(high >= high.max() / 2)[0]]])
+        if best is None:
+            return x0, y0, x1 - x0 + 1, y1 - y0 + 1
+        xs = xs[~best[1]]
+        ys = ys[~best[1]]
+
+# Grid cells hold a packed tile id: (type id + 1) << 8 | variant, with 0 meaning no tile. That's 2 bytes per cell.
+def pack_tile(type_id, variant):
+    return (type_id + 1) << 8 | variant
+
+class TileGridView(MutableMapping):
+    # Dict-like view over the packed grid using the JSON 'x;y' -> {'type', 'variant', 'pos'} layout, so saving and old callers keep working.
+    # Tile dicts are built on demand, so changing one doesn't change the map (use Tilemap.set_tile for that).
+    def __init__(self, tilemap):
+        self.tilemap = tilemap
+
+    def __getitem__(self, loc):
+        x, y = loc.split(';')
+        tile_id = self.tilemap.tile_id(int(x), int(y))
+        if not tile_id:
+            raise KeyError(loc)
+        return self.tilemap.tile_dict(int(x), int(y), tile_id)
+
+    def __setitem__(self, loc, tile):
+        self.tilemap.set_tile(tile['pos'], tile['type'], tile['variant'])
+
+    def __delitem__(self, loc):
+        x, y = loc.split(';')
+        if not self.tilemap.tile_id(int(x), int(y)):
+            raise KeyError(loc)
+        self.tilemap.remove_tile((int(x), int(y)))
+
+    def __iter__(self):
+        for x, y, tile_id in self.tilemap.iter_tiles():
+            yield str(x) + ';' + str(y)
+
+    def __len__(self):
+        return self.tilemap.tile_count
+
 
 class Tilemap:
+    sparse_limit = SPARSE_LIMIT # None for maps that keep every tile in sparse and never compact
+
     def __init__(self, game, tile_size=16):
         self.game = game
         self.tile_size = tile_size
         self.offgrid_tiles = [] # Decor tiles that may not align to grid
-        self.tilemap = {} # Square grid of tiles mapped based on location
+        self.chunks = {} # Pre-rendered (chunk surface, chunk outline) mapped by chunk location, baked lazily when first rendered
+
+        self.tile_types = [] # String table, a tile's type id is its index in here
+        self.type_ids = {}
+        self.solid_types = bytearray(1) # Indexed by packed id >> 8, 1 if that type has physics (slot 0 is "no tile")
+        self.autotile_types = bytearray(1) # Same, 1 if that type gets autotiled
+
+        # Dense grid covering the main body of the map, row major, plus a sparse dict for tiles outside it (stray ones or newly placed)
+        self.grid_x = 0
+        self.grid_y = 0
+        self.grid_w = 0
+        self.grid_h = 0
+        self.grid = array('H')
+        self.sparse = {}
+        self.sparse_floor = 0 # Tiles compact() left in sparse (too far from the rest), write_tile only compacts again once SPARSE_LIMIT more are there
+        self.tile_count = 0
+        self.shared = False # True while grid, sparse and offgrid_tiles are shared with a snapshot (copied on the first write)
+
+        # Where every tile of each kind is: packed id -> {(x, y): None} for grid tiles and (type, variant) -> {id(tile): tile}
+        # for offgrid tiles, dicts so they keep map order. Built the first time it's needed after a load and kept up to date by edits.
+        self.grid_index = None
+        self.offgrid_index = None
+
+        # Offgrid tiles bucketed by the chunks their images overlap, chunk location -> {id(tile): tile} in map order, so baking
+        # a chunk or picking a tile in the editor only looks at the decor nearby. Built lazily and kept up to date like the index.
+        self.offgrid_buckets = None
+
+        # One bit per dense grid cell, set if the tile there is solid (rows padded to whole bytes, highest bit first).
+        # Built when a raycast first needs it and kept up to date by edits.
+        self.solid_bits = None
+        self.solid_stride = 0
+
+        self.tilemap = TileGridView(self) # Square grid of tiles mapped based on location (JSON style view of self.grid)
+
+    def reset_types(self, tile_types=()):
+        # Starts a fresh string table (type ids only need to be stable within one loaded map)
+        self.tile_types = []
+        self.type_ids = {}
+        self.solid_types = bytearray(1)
+        self.autotile_types = bytearray(1)
+        for tile_type in tile_types:
+            self.type_id(tile_type)
+
+    def type_id(self, tile_type):
+        if tile_type not in self.type_ids:
+            self.type_ids[tile_type] = len(self.tile_types)
+            self.tile_types.append(tile_type)
+            self.solid_types.append(tile_type in PHYSICS_TILES)
+            self.autotile_types.append(tile_type in AUTOTILE_TYPES)
+        return self.type_ids[tile_type]
+
+    def tile_id(self, x, y):
+        # Plain index arithmetic, no strings or dicts involved
+        gx = x - self.grid_x
+        gy = y - self.grid_y
+        if 0 <= gx < self.grid_w and 0 <= gy < self.grid_h:
+            return self.grid[gy * self.grid_w + gx]
+        return self.sparse.get((x, y), 0)
+
+    def tile_dict(self, x, y, tile_id):
+        return {'type': self.tile_types[(tile_id >> 8) - 1], 'variant': tile_id & 0xFF, 'pos': [x, y]}
+
+    def tile_img(self, tile_id):
+        return self.game.assets[self.tile_types[(tile_id >> 8) - 1]][tile_id & 0xFF]
+
+    def iter_tiles(self):
+        for i, tile_id in enumerate(self.grid):
+            if tile_id:
+                yield self.grid_x + i % self.grid_w, self.grid_y + i // self.grid_w, tile_id
+        for loc, tile_id in list(self.sparse.items()):
+            yield loc[0], loc[1], tile_id
+
+    def count_tiles(self):
+        return int(np.count_nonzero(np.frombuffer(self.grid, dtype=np.uint16))) + len(self.sparse)
+
+    def build_index(self):
+        if self.grid_index is None:
+            self.grid_index = {}
+            for x, y, tile_id in self.iter_tiles():
+                self.grid_index.setdefault(tile_id, {})[(x, y)] = None
+            self.offgrid_index = {}
+            for tile in self.offgrid_tiles:
+                self.offgrid_index.setdefault((tile['type'], tile['variant']), {})[id(tile)] = tile
+
+    def build_offgrid_buckets(self):
+        if self.offgrid_buckets is None:
+            self.offgrid_buckets = {}
+            for tile in self.offgrid_tiles:
+                self.bucket_offgrid(tile)
+
+    def bucket_offgrid(self, tile):
+        for chunk_loc in self.offgrid_chunks(tile):
+            self.offgrid_buckets.setdefault(chunk_loc, {})[id(tile)] = tile
+
+    def unbucket_offgrid(self, tile):
+        for chunk_loc in self.offgrid_chunks(tile):
+            self.offgrid_buckets[chunk_loc].pop(id(tile), None)
+
+    def snapshot(self):
+        # Captures the tiles as they are now so restore() can bring them back without reloading the map.
+        # Nothing is copied here: the snapshot shares the tile storage and the tilemap copies it the first time it's changed.
+        self.shared = True
+        return (self.grid_x, self.grid_y, self.grid_w, self.grid_h, self.grid, self.sparse, self.offgrid_tiles, self.tile_count)
+
+    def restore(self, snapshot):
+        if self.shared and self.grid is snapshot[4]:
+            return # Nothing was changed since the snapshot, even the pre-rendered chunks are still right
+        self.grid_x, self.grid_y, self.grid_w, self.grid_h, self.grid, self.sparse, self.offgrid_tiles, self.tile_count = snapshot
+        self.shared = True
+        self.grid_index = self.offgrid_index = self.offgrid_buckets = None
+        self.solid_bits = None
+        self.invalidate_all()
+
+    def unshare(self):
+        if self.shared:
+            self.grid = array('H', self.grid)
+            self.sparse = dict(self.sparse)
+            self.offgrid_tiles = list(self.offgrid_tiles)
+            self.shared = False
+
+    def write_tile(self, x, y, tile_id):
+        # Stores a packed id (0 clears the cell) and keeps tile_count in step
+        self.unshare()
+        gx = x - self.grid_x
+        gy = y - self.grid_y
+        if 0 <= gx < self.grid_w and 0 <= gy < self.grid_h:
+            old_id = self.grid[gy * self.grid_w + gx]
+            self.grid[gy * self.grid_w + gx] = tile_id
+        else:
+            old_id = self.sparse.pop((x, y), 0)
+            if tile_id:
+                self.sparse[(x, y)] = tile_id
+        self.tile_count += bool(tile_id) - bool(old_id)
+        if self.grid_index is not None:
+            if old_id:
+                del self.grid_index[old_id][(x, y)]
+            if tile_id:
+                self.grid_index.setdefault(tile_id, {})[(x, y)] = None
+        if self.solid_types[old_id >> 8] != self.solid_types[tile_id >> 8] and self.solid_bits is not None and 0 <= gx < self.grid_w and 0 <= gy < self.grid_h:
+            self.solid_bits[gy * self.solid_stride + (gx >> 3)] ^= 0x80 >> (gx & 7)
+        if self.sparse_limit is not None and len(self.sparse) > self.sparse_floor + self.sparse_limit:
+            self.compact()
+
+    def compact(self):
+        # Rebuilds the dense grid around the main body of the map (see grid_bounds), outliers stay in the sparse dict
+        tiles = list(self.iter_tiles())
+        self.grid_x, self.grid_y, self.grid_w, self.grid_h = grid_bounds(tiles)
+        self.grid = array('H', bytes(2 * self.grid_w * self.grid_h))
+        self.sparse = {}
+        self.solid_bits = None
+        for x, y, tile_id in tiles:
+            gx = x - self.grid_x
+            gy = y - self.grid_y
+            if 0 <= gx < self.grid_w and 0 <= gy < self.grid_h:
+                self.grid[gy * self.grid_w + gx] = tile_id
+            else:
+                self.sparse[(x, y)] = tile_id
+        self.sparse_floor = len(self.sparse)
 
     def extract(self, id_pairs, keep=False):
+        # Goes straight to the matching tiles through the index, so the cost doesn't grow with the size of the map.
+        # Matches come out grouped by id pair (offgrid tiles first), in map order within each.
+        self.build_index()
         matches = []
-        for tile in self.offgrid_tiles.copy():
-            if (tile['type'], tile['variant']) in id_pairs:
+        removed = {}
+        for tile_type, variant in id_pairs:
+            for tile in list(self.offgrid_index.get((tile_type, variant), {}).values()):
                 matches.append(tile.copy())
                 if not keep:
-                    self.offgrid_tiles.remove(tile)
-                    
-        for loc in self.tilemap:
-            tile = self.tilemap[loc]
-            if (tile['type'], tile['variant']) in id_pairs:
-                matches.append(tile.copy())
-                matches[-1]['pos'] = matches[-1]['pos'].copy()
-                matches[-1]['pos'][0] *= self.tile_size
-                matches[-1]['pos'][1] *= self.tile_size
+                    removed[id(tile)] = tile
+
+        if removed:
+            # One pass over the offgrid list instead of a list.remove() per match
+            self.unshare()
+            self.offgrid_tiles = [tile for tile in self.offgrid_tiles if id(tile) not in removed]
+            for tile in removed.values():
+                del self.offgrid_index[(tile['type'], tile['variant'])][id(tile)]
+                if self.offgrid_buckets is not None:
+                    self.unbucket_offgrid(tile)
+                self.invalidate_offgrid(tile)
+
+        for tile_type, variant in id_pairs:
+            if tile_type not in self.type_ids:
+                continue
+            tile_id = pack_tile(self.type_ids[tile_type], variant)
+            for x, y in list(self.grid_index.get(tile_id, ())):
+                tile = self.tile_dict(x, y, tile_id)
+                tile['pos'][0] *= self.tile_size
+                tile['pos'][1] *= self.tile_size
+                matches.append(tile)
                 if not keep:
-                    del self.tilemap[loc]
+                    self.remove_tile((x, y))
         
         return matches
+
+    # All edits should go through these so only the chunks they touch get re-rendered.
+    def set_tile(self, tile_pos, tile_type, variant):
+        tile_id = pack_tile(self.type_id(tile_type), variant)
+        if self.tile_id(tile_pos[0], tile_pos[1]) == tile_id:
+            return False # Painting over the same tile (e.g. holding the mouse down) shouldn't re-render its chunk every frame
+        self.write_tile(tile_pos[0], tile_pos[1], tile_id)
+        self.invalidate_tile(tile_pos)
+        return True
+
+    def remove_tile(self, tile_pos):
+        if self.tile_id(tile_pos[0], tile_pos[1]):
+            self.write_tile(tile_pos[0], tile_pos[1], 0)
+            self.invalidate_tile(tile_pos)
+            return True
+        return False
+
+    def add_offgrid(self, tile):
+        self.unshare()
+        self.offgrid_tiles.append(tile)
+        if self.offgrid_index is not None:
+            self.offgrid_index.setdefault((tile['type'], tile['variant']), {})[id(tile)] = tile
+        if self.offgrid_buckets is not None:
+            self.bucket_offgrid(tile)
+        self.invalidate_offgrid(tile)
+
+    def remove_offgrid(self, tile):
+        self.unshare()
+        self.offgrid_tiles.remove(tile)
+        if self.offgrid_index is not None:
+            self.offgrid_index[(tile['type'], tile['variant'])].pop(id(tile), None)
+        if self.offgrid_buckets is not None:
+            self.unbucket_offgrid(tile)
+        self.invalidate_offgrid(tile)
+
+    def offgrid_at(self, pos):
+        # Offgrid tiles whose image covers a pixel, checking only the ones bucketed in that pixel's chunk
+        self.build_offgrid_buckets()
+        chunk_px = self.tile_size * CHUNK_SIZE
+        bucket = self.offgrid_buckets.get((math.floor(pos[0]) // chunk_px, math.floor(pos[1]) // chunk_px), {})
+        return [tile for tile in bucket.values() if tile['type'] in self.game.assets and self.offgrid_rect(tile).collidepoint(pos)]
+
+    def invalidate_offgrid(self, tile):
+        if tile['type'] in self.game.assets: # The game has no images for some types (e.g. spawners), those are always extracted before anything is drawn
+            self.invalidate_rect(self.offgrid_rect(tile))
+
+    def offgrid_rect(self, tile):
+        img = self.game.assets[tile['type']][tile['variant']]
+        return pygame.Rect(math.floor(tile['pos'][0]), math.floor(tile['pos'][1]), img.get_width(), img.get_height())
+
+    def offgrid_chunks(self, tile):
+        # The chunks a tile's image overlaps, types without an image are put in the chunk their position is in
+        chunk_px = self.tile_size * CHUNK_SIZE
+        if tile['type'] in self.game.assets:
+            rect = self.offgrid_rect(tile)
+        else:
+            rect = pygame.Rect(math.floor(tile['pos'][0]), math.floor(tile['pos'][1]), 1, 1)
+        return [(cx, cy) for cx in range(rect.left // chunk_px, (rect.right - 1) // chunk_px + 1) for cy in range(rect.top // chunk_px, (rect.bottom - 1) // chunk_px + 1)]
+
+    def invalidate_tile(self, tile_pos):
+        self.chunks.pop((tile_pos[0] // CHUNK_SIZE, tile_pos[1] // CHUNK_SIZE), None)
+
+    def invalidate_rect(self, rect):
+        # Drops every chunk a pixel rect overlaps (an offgrid tile can straddle a chunk border)
+        chunk_px = self.tile_size * CHUNK_SIZE
+        for cx in range(rect.left // chunk_px, (rect.right - 1) // chunk_px + 1):
+            for cy in range(rect.top // chunk_px, (rect.bottom - 1) // chunk_px + 1):
+                self.chunks.pop((cx, cy), None)
+
+    def invalidate_all(self):
+        self.chunks = {}
+
+    def bake_chunk(self, chunk_loc):
+        # Draws everything inside a chunk once, in the same order render used to draw it (offgrid decor underneath grid tiles)
+        chunk_px = self.tile_size * CHUNK_SIZE
+        origin = (chunk_loc[0] * chunk_px, chunk_loc[1] * chunk_px)
+        surf = pygame.Surface((chunk_px, chunk_px), pygame.SRCALPHA)
+        empty = True
+
+        self.build_offgrid_buckets()
+        for tile in self.offgrid_buckets.get(chunk_loc, {}).values(): # Only the decor overlapping this chunk is in its bucket
+            empty = False
+            # Offgrid positions can be fractional, floor them so a tile straddling chunks lands on the same pixel in each
+            surf.blit(self.game.assets[tile['type']][tile['variant']], (math.floor(tile['pos'][0]) - origin[0], math.floor(tile['pos'][1]) - origin[1]))
+
+        for x in range(chunk_loc[0] * CHUNK_SIZE, (chunk_loc[0] + 1) * CHUNK_SIZE):
+            for y in range(chunk_loc[1] * CHUNK_SIZE, (chunk_loc[1] + 1) * CHUNK_SIZE):
+                tile_id = self.tile_id(x, y)
+                if tile_id:
+                    empty = False
+                    surf.blit(self.tile_img(tile_id), (x * self.tile_size - origin[0], y * self.tile_size - origin[1]))
+
+        self.chunks[chunk_loc] = None if empty else (surf, make_outline(surf)) # Empty chunks are remembered too so they are never blitted or baked again
     
-    def render(self, surf, offset=(0, 0)):
-        for tile in self.offgrid_tiles:
-            surf.blit(self.game.assets[tile['type']][tile['variant']], (tile['pos'][0] - offset[0], tile['pos'][1] - offset[1]))
-
-        # Offset describes the current position of the camera, using this, we can obtain all visible tiles and only render those.
-        # Divide by tile_size to get tile coordinates. The first component is the left most x value and the second is the right most (+ 1 for error)
-        for x in range(offset[0] // self.tile_size, (offset[0] + surf.get_width()) // self.tile_size + 1):
-            # Grab every y-value for each x-value.
-            for y in range(offset[1] // self.tile_size, (offset[1] + surf.get_height()) // self.tile_size + 1):
-                # Grab location of tile
-                loc = str(x) + ';' + str(y)
-                if loc in self.tilemap:
-                    # Render it
-                    tile = self.tilemap[loc]
-                    surf.blit(self.game.assets[tile['type']][tile['variant']], (tile['pos'][0] * self.tile_size - offset[0], tile['pos'][1] * self.tile_size - offset[1]))
+    def render(self, surf, offset=(0, 0), shadow_surf=None):
+        # Offset describes the current position of the camera, using this, we can obtain all visible chunks and only render those.
+        # Divide by the chunk size in pixels to get chunk coordinates, so a whole screen is only a handful of blits.
+        # Each chunk's outline goes onto shadow_surf if one is given.
+        chunk_px = self.tile_size * CHUNK_SIZE
+        for cx in range(offset[0] // chunk_px, (offset[0] + surf.get_width()) // chunk_px + 1):
+            for cy in range(offset[1] // chunk_px, (offset[1] + surf.get_height()) // chunk_px + 1):
+                if (cx, cy) not in self.chunks:
+                    self.bake_chunk((cx, cy))
+                chunk = self.chunks[(cx, cy)]
+                if chunk is not None:
+                    surf.blit(chunk[0], (cx * chunk_px - offset[0], cy * chunk_px - offset[1]))
+                    if shadow_surf:
+                        shadow_surf.blit(chunk[1], (cx * chunk_px - offset[0] - 1, cy * chunk_px - offset[1] - 1))
+
+    def stream(self, rect):
+        pass # The whole map is already in memory, see StreamingTilemap (scripts/world.py) for maps that aren't
 
     def tiles_around(self, pos):
         tiles = []
         tile_loc = (int(pos[0] // self.tile_size), int(pos[1] // self.tile_size)) # Finds location of the player.
         for offset in NEIGHBOUR_OFFSETS:
-            check_loc = str(tile_loc[0] + offset[0]) + ';' + str(tile_loc[1] + offset[1]) # Check each of the 9 tiles
-            if check_loc in self.tilemap:
-                tiles.append(self.tilemap[check_loc])
+            tile_id = self.tile_id(tile_loc[0] + offset[0], tile_loc[1] + offset[1]) # Check each of the 9 tiles
+            if tile_id:
+                tiles.append(self.tile_dict(tile_loc[0] + offset[0], tile_loc[1] + offset[1], tile_id))
         return tiles
 
     def save(self, path):
+        # Paths ending in .lvl get the binary level format, anything else JSON
+        if path.endswith('.lvl'):
+            self.compact()
+            save_level(self, path)
+            return
         f = open(path, 'w')
-        json.dump({'tilemap': self.tilemap, 'tile_size': self.tile_size, 'offgrid': self.offgrid_tiles}, f)
+        json.dump({'tilemap': dict(self.tilemap), 'tile_size': self.tile_size, 'offgrid': self.offgrid_tiles}, f)
         f.close()
 
     def load(self, path):
+        # Works out the format from the file itself, binary levels are memory mapped rather than parsed
+        self.shared = False # Whatever the last snapshot held is replaced, not written to
+        self.grid_index = self.offgrid_index = self.offgrid_buckets = None
+        self.solid_bits = None
+        if is_binary_level(path):
+            load_level(self, path)
+            self.sparse_floor = len(self.sparse)
+            self.invalidate_all()
+            return
+
         f = open(path, 'r')
         map_data = json.load(f)
         f.close()
 
-        self.tilemap = map_data['tilemap']
         self.tile_size = map_data['tile_size']
         self.offgrid_tiles = map_data['offgrid']
 
+        # Everything goes into the sparse dict first, compact() then sizes the dense grid to fit
+        self.reset_types()
+        self.grid_x = self.grid_y = self.grid_w = self.grid_h = 0
+        self.grid = array('H')
+        self.sparse = {}
+        for tile in map_data['tilemap'].values():
+            self.sparse[(tile['pos'][0], tile['pos'][1])] = pack_tile(self.type_id(tile['type']), tile['variant'])
+        self.tile_count = len(self.sparse)
+        self.compact()
+        self.invalidate_all()
+
     def solid_check(self, pos):
-        tile_loc = str(int(pos[0] // self.tile_size)) + ";" + str(int(pos[1] // self.tile_size))
-        if tile_loc in self.tilemap:
-            if self.tilemap[tile_loc]['type'] in PHYSICS_TILES:
-                return self.tilemap[tile_loc]
-
-    def physics_rects_around(self, pos):
-        rects = []
-        for tile in self.tiles_around(pos): # Filters found tiles based on whether or not they have physics.
-            if tile['type'] in PHYSICS_TILES:
-                rects.append(pygame.Rect(tile['pos'][0] * self.tile_size, tile['pos'][1] * self.tile_size, self.tile_size, self.tile_size))
-        return rects
+        return self.solid_types[self.tile_id(int(pos[0] // self.tile_size), int(pos[1] // self.tile_size)) >> 8] == 1
+
+    def solid_check_many(self, positions):
+        # solid_check for an (n, 2) array of pixel positions at once, returns a bool array
+        tile_x = np.floor(positions[:, 0] / self.tile_size).astype(np.int64) - self.grid_x
+        tile_y = np.floor(positions[:, 1] / self.tile_size).astype(np.int64) - self.grid_y
+        in_grid = (tile_x >= 0) & (tile_x < self.grid_w) & (tile_y >= 0) & (tile_y < self.grid_h)
+        tile_ids = np.zeros(len(positions), dtype=np.int64)
+        tile_ids[in_grid] = np.frombuffer(self.grid, dtype=np.uint16)[tile_y[in_grid] * self.grid_w + tile_x[in_grid]]
+        for i in np.flatnonzero(~in_grid): # Anything outside the dense grid falls back to the sparse dict
+            tile_ids[i] = self.sparse.get((int(tile_x[i]) + self.grid_x, int(tile_y[i]) + self.grid_y), 0)
+        return np.frombuffer(self.solid_types, dtype=np.uint8)[tile_ids >> 8] == 1
+
+    def build_collision(self):
+        # Packs the solid bitmap up front, the level loader runs this on its thread as part of reading a map
+        self.build_solid_bits()
+
+    def build_solid_bits(self):
+        solid = np.frombuffer(self.solid_types, dtype=np.uint8)[np.frombuffer(self.grid, dtype=np.uint16) >> 8]
+        self.solid_bits = bytearray(np.packbits(solid.reshape(self.grid_h, self.grid_w), axis=1).tobytes())
+        self.solid_stride = (self.grid_w + 7) // 8
+
+    def raycast(self, origin, direction, max_dist):
+        # Steps along the ray one tile boundary at a time (DDA) and returns how far along it (in pixels) the first solid tile is,
+        # 0 if origin is already in one, or None if nothing solid is within max_dist. direction doesn't need to be normalised.
+        if self.solid_bits is None:
+            self.build_solid_bits()
+        length = math.hypot(direction[0], direction[1])
+        if not length:
+            return 0 if self.solid_check(origin) else None
+        dx = direction[0] / length
+        dy = direction[1] / length
+        tile_x = math.floor(origin[0] / self.tile_size)
+        tile_y = math.floor(origin[1] / self.tile_size)
+
+        # How far along the ray the next column/row boundary is, and how far apart boundaries are
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+        delta_x = self.tile_size / abs(dx) if dx else math.inf
+        delta_y = self.tile_size / abs(dy) if dy else math.inf
+        next_x = ((tile_x + (dx > 0)) * self.tile_size - origin[0]) / dx if dx else math.inf
+        next_y = ((tile_y + (dy > 0)) * self.tile_size - origin[1]) / dy if dy else math.inf
+
+        bits = self.solid_bits
+        stride = self.solid_stride
+        dist = 0
+        while dist <= max_dist:
+            gx = tile_x - self.grid_x
+            gy = tile_y - self.grid_y
+            if 0 <= gx < self.grid_w and 0 <= gy < self.grid_h:
+                if bits[gy * stride + (gx >> 3)] & (0x80 >> (gx & 7)):
+                    return dist
+            elif self.solid_types[self.sparse.get((tile_x, tile_y), 0) >> 8]:
+                return dist
+            if next_x < next_y:
+                dist = next_x
+                next_x += delta_x
+                tile_x += step_x
+            else:
+                dist = next_y
+                next_y += delta_y
+                tile_y += step_y
+        return None
+
+    def first_solid(self, lines, span, vertical=False):
+        # Goes through tile columns (rows if vertical) in the order given and returns the first one with a solid tile
+        # anywhere in span (the rows/columns the moving box covers), or None if they're all clear
+        for line in lines:
+            for other in span:
+                if self.solid_types[(self.tile_id(other, line) if vertical else self.tile_id(line, other)) >> 8]:
+                    return line
+        return None
+
+    def autotile_tile(self, x, y):
+        # Picks the variant for one tile from which of its 4 neighbours are the same type (whatever their variant)
+        tile_id = self.tile_id(x, y)
+        if not self.autotile_types[tile_id >> 8]:
+            return
+        mask = 0
+        for shift, bit in NEIGHBOUR_BITS.items():
+            if self.tile_id(x + shift[0], y + shift[1]) >> 8 == tile_id >> 8:
+                mask |= bit
+        variant = AUTOTILE_MASKS[mask]
+        if variant >= 0 and variant != tile_id & 0xFF:
+            self.write_tile(x, y, (tile_id & 0xFF00) | int(variant))
+            self.invalidate_tile((x, y))
+
+    def autotile_at(self, tile_pos):
+        # After a tile is placed or removed only it and its 4 neighbours can need a different variant
+        self.autotile_tile(tile_pos[0], tile_pos[1])
+        for shift in NEIGHBOUR_BITS:
+            self.autotile_tile(tile_pos[0] + shift[0], tile_pos[1] + shift[1])
+
+    def autotile_block(self, ids, padded):
+        # Autotiles a 2D block of packed ids in place. padded is their types with a 1 tile border of the types around the block
+        # (0 where there's nothing). Returns the rows and columns of the tiles that changed.
+        h, w = ids.shape
+        types = padded[1:-1, 1:-1]
+        mask = np.zeros(types.shape, dtype=np.uint8)
+        for shift, bit in NEIGHBOUR_BITS.items():
+            mask |= (padded[1 + shift[1]:1 + shift[1] + h, 1 + shift[0]:1 + shift[0] + w] == types) * np.uint8(bit)
+        variants = AUTOTILE_MASKS[mask]
+        changed = (np.frombuffer(self.autotile_types, dtype=np.uint8)[types] == 1) & (variants >= 0) & (variants != (ids & 0xFF))
+        gy, gx = np.nonzero(changed)
+        ids[gy, gx] = (ids[gy, gx] & 0xFF00) | variants[gy, gx].astype(np.uint16)
+        return gy, gx
 
     def autotile(self):
-        for loc in self.tilemap:
-            tile = self.tilemap[loc]
-            neighbours = set()
-            for shift in [(1, 0), (-1, 0), (0, -1), (0, 1)]:
-                check_loc = str(tile['pos'][0] + shift[0]) + ';' + str(tile['pos'][1] + shift[1])
-                if check_loc in self.tilemap:
-                    if self.tilemap[check_loc]['type'] == tile['type']:
-                        neighbours.add(shift)
-            neighbours = tuple(sorted(neighbours))
-            if (tile['type'] in AUTOTILE_TYPES) and (neighbours in AUTOTILE_MAP):
-                tile['variant'] = AUTOTILE_MAP[neighbours]
\ No newline at end of file
+        # The whole map at once. A tile's new variant only depends on its neighbours' types, which autotiling never changes,
+        # so every tile in the dense grid can be worked out together from shifted copies of the grid.
+        self.unshare()
+        ids = np.frombuffer(self.grid, dtype=np.uint16).reshape(self.grid_h, self.grid_w)
+        padded = np.zeros((self.grid_h + 2, self.grid_w + 2), dtype=np.uint16) # Outside the grid counts as empty here, sparse tiles are done below
+        padded[1:-1, 1:-1] = ids >> 8
+        gy, gx = self.autotile_block(ids, padded)
+
+        self.grid_index = self.offgrid_index = None # Variants are part of the ids it's keyed by
+        for chunk_loc in set(zip(((gx + self.grid_x) // CHUNK_SIZE).tolist(), ((gy + self.grid_y) // CHUNK_SIZE).tolist())):
+            self.chunks.pop(chunk_loc, None)
+
+        # Tiles outside the grid, and grid tiles next to them, one at a time (there are never many)
+        for x, y in list(self.sparse):
+            self.autotile_at((x, y))
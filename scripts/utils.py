@@ -1,22 +1,85 @@
 import pygame
-import os
+import numpy as np
+from collections import OrderedDict
 
 BASE_IMG_PATH = 'data/images/'
 
-def load_image(path):
-    img = pygame.image.load(BASE_IMG_PATH + path).convert() # .convert() increases efficiency
-    img.set_colorkey((0, 0, 0)) # Makes a colour transparent (remove background)
+TRANSFORM_CACHE_SIZE = 256 # Transformed copies (and outlines of surfaces that aren't assets) kept before the least recently used go
+OUTLINE_OFFSETS = [(-1, 0), (1, 0), (0, 1), (0, -1)]
+# Outline alpha where 0 to 4 of the shifted silhouettes overlap, as dark as blitting a 180 alpha silhouette that many times
+OUTLINE_ALPHA = np.array([round(255 - 255 * (1 - 180 / 255) ** k) for k in range(5)], dtype=np.uint8)
+
+def prepare_image(img):
+    # The display dependent part of loading an image, has to happen on the main thread once the window exists
+    img = img.convert() # .convert() increases efficiency
+    img.set_colorkey((0, 0, 0), pygame.RLEACCEL) # Makes a colour transparent (remove background)
     return img
 
-def load_images(path):
-    images = []
-    for img_name in sorted(os.listdir(BASE_IMG_PATH + path)): # Gets all files in path
-        images.append(load_image(path + '/' + img_name))
-    return images
+def make_outline(img):
+    # The dark drop outline around img's solid pixels, 1 pixel bigger on every side (so it gets blitted at pos - 1)
+    w, h = img.get_size()
+    silhouette = pygame.mask.from_surface(img).to_surface(setcolor=(255, 255, 255, 255), unsetcolor=(0, 0, 0, 255))
+    solid = pygame.surfarray.array3d(silhouette)[:, :, 0] > 0
+    overlaps = np.zeros((w + 2, h + 2), dtype=np.uint8)
+    for offset in OUTLINE_OFFSETS:
+        overlaps[1 + offset[0]:1 + offset[0] + w, 1 + offset[1]:1 + offset[1] + h] += solid
+    outline_surf = pygame.Surface((w + 2, h + 2), pygame.SRCALPHA)
+    pygame.surfarray.pixels_alpha(outline_surf)[:] = OUTLINE_ALPHA[overlaps]
+    return outline_surf
+
+asset_outlines = {} # Surface -> its outline for the loaded assets, filled by preload_outlines() and kept for good
+outlines = OrderedDict() # Outlines of any other surface (transformed copies), least recently used first, at most TRANSFORM_CACHE_SIZE
+
+def outline(img):
+    if img in asset_outlines:
+        return asset_outlines[img]
+    if img in outlines:
+        outlines.move_to_end(img)
+        return outlines[img]
+    outlines[img] = make_outline(img)
+    if len(outlines) > TRANSFORM_CACHE_SIZE: # Dropped like the transformed copies, so an evicted copy isn't kept alive through its outline
+        outlines.popitem(last=False)
+    return outlines[img]
+
+def preload_outlines(assets):
+    # Works out the outline of every image in a list of assets (images, lists of images or Animations, both ways round) at load time
+    for asset in assets:
+        for img in (asset.images + asset.flipped_images if isinstance(asset, Animation) else asset if isinstance(asset, list) else [asset]):
+            if img not in asset_outlines:
+                asset_outlines[img] = outlines.pop(img, None) or make_outline(img)
+
+class TransformCache:
+    # Transformed copies of surfaces keyed by (surface, flip x, flip y, scale), so each transform is only done once.
+    # Once it holds max_size copies, the least recently used one is dropped.
+    def __init__(self, max_size=TRANSFORM_CACHE_SIZE):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+
+    def get(self, img, flip_x=False, flip_y=False, scale=None):
+        key = (img, flip_x, flip_y, scale)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        transformed = img
+        if scale:
+            transformed = pygame.transform.scale(transformed, scale)
+        if flip_x or flip_y:
+            transformed = pygame.transform.flip(transformed, flip_x, flip_y)
+        self.cache[key] = transformed
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return transformed
+
+transforms = TransformCache()
+
+def flip(img):
+    # img mirrored horizontally, from the transform cache
+    return transforms.get(img, flip_x=True)
 
 class Animation:
-    def __init__(self, images, img_dur=5, loop=True):
+    def __init__(self, images, img_dur=5, loop=True, flipped_images=None):
         self.images = images
+        self.flipped_images = flipped_images or [pygame.transform.flip(img, True, False) for img in images] # Mirrored frames made once at load, for entities facing left
         self.img_duration = img_dur
         self.loop = loop
         self.done = False
@@ -24,7 +87,7 @@ class Animation:
     
     def copy(self):
         # A copy is nice to have as self.done and self.frame are specific to each animation but not the others. Also, it saves memory by passing reference to self.images
-        return Animation(self.images, self.img_duration, self.loop)
+        return Animation(self.images, self.img_duration, self.loop, self.flipped_images)
 
     def update(self):
         if self.loop:
@@ -34,8 +97,8 @@ class Animation:
             if self.frame >= self.img_duration * len(self.images) - 1:
                 self.done = True
 
-    def img(self):
+    def img(self, flip=False):
         # This works because int truncates, so we access the same index self.img_duration times.
-        return self.images[int(self.frame / self.img_duration)]
+        return (self.flipped_images if flip else self.images)[int(self.frame / self.img_duration)]
     
 
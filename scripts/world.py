@@ -0,0 +1,432 @@
+import json
+import math
+import os
+import tempfile
+from array import array
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from scripts.tilemap import Tilemap, CHUNK_SIZE, pack_tile
+from scripts.level_format import save_region, load_region
+
+# A streamed world is a directory holding world.json (tile size, region size, the tile type table, how many tiles every
+# region has and where its MARKER_TYPES tiles are) and one r.<x>.<y>.rgn file per region. Only the regions around the
+# camera are kept in memory.
+REGION_CHUNKS = 4 # Regions are REGION_CHUNKS x REGION_CHUNKS chunks, so every chunk belongs to exactly one region
+REGION_SIZE = REGION_CHUNKS * CHUNK_SIZE # Region width and height in tiles
+MAX_REGIONS = 32 # Regions kept loaded before the least recently used are dropped (ones with unsaved edits are spilled to a scratch file)
+STREAM_MARGIN = 1 # Regions this far past the camera are read in the background before they come into view
+MARKER_TYPES = {'spawners', 'large_decor'} # Listed in the manifest, so extract() can find the ones a level load needs without reading every region
+
+REGION_LOADER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='region-loader')
+
+def is_world(path):
+    return os.path.isfile(os.path.join(path, 'world.json'))
+
+def region_path(world_dir, loc):
+    return os.path.join(world_dir, 'r.' + str(loc[0]) + '.' + str(loc[1]) + '.rgn')
+
+def save_world(tilemap, path):
+    # Splits a map that's all in memory into a world directory (convert_map.py uses this)
+    world = StreamingTilemap(tilemap.game, tilemap.tile_size)
+    world.reset_types(tilemap.tile_types)
+    for x, y, tile_id in tilemap.iter_tiles():
+        world.write_tile(x, y, tile_id)
+    for tile in tilemap.offgrid_tiles:
+        world.add_offgrid(dict(tile))
+    world.save(path)
+
+def read_world(game, path):
+    # The other way round, the whole world in one Tilemap
+    world = StreamingTilemap(game)
+    world.load(path)
+    tilemap = Tilemap(game, world.tile_size)
+    tilemap.reset_types(world.tile_types)
+    tilemap.sparse = {(x, y): tile_id for x, y, tile_id in world.iter_tiles()}
+    tilemap.tile_count = len(tilemap.sparse)
+    tilemap.compact()
+    for loc in sorted(world.region_counts):
+        tilemap.offgrid_tiles.extend(world.region(loc).offgrid)
+    return tilemap
+
+def region_ids(region):
+    # A region's packed ids as a rows x columns array, writes go straight into the region
+    return np.frombuffer(region.grid, dtype=np.uint16).reshape(REGION_SIZE, REGION_SIZE)
+
+class Region:
+    def __init__(self, loc, grid=None, offgrid=None):
+        self.loc = loc
+        self.grid = array('H', bytes(2 * REGION_SIZE * REGION_SIZE)) if grid is None else grid # Packed ids, row major
+        self.offgrid = [] if offgrid is None else offgrid # Offgrid tiles positioned inside the region
+        self.dirty = False # Edited since it was read or saved, these are never evicted
+
+class RegionTiles(MutableMapping):
+    # Takes the place of Tilemap.sparse for a streamed world: (x, y) -> packed id over every region, reading regions in as they're needed.
+    # The dense grid is left empty, so every Tilemap query falls through to this and works the same whether a region is loaded or not.
+    def __init__(self, tilemap):
+        self.tilemap = tilemap
+
+    def get(self, loc, default=0):
+        region = self.tilemap.region((loc[0] // REGION_SIZE, loc[1] // REGION_SIZE))
+        if region is None:
+            return default
+        return region.grid[(loc[1] % REGION_SIZE) * REGION_SIZE + loc[0] % REGION_SIZE] or default
+
+    def __getitem__(self, loc):
+        tile_id = self.get(loc)
+        if not tile_id:
+            raise KeyError(loc)
+        return tile_id
+
+    def __setitem__(self, loc, tile_id):
+        region_loc = (loc[0] // REGION_SIZE, loc[1] // REGION_SIZE)
+        region = self.tilemap.region(region_loc)
+        if region is None:
+            if not tile_id:
+                return
+            region = self.tilemap.create_region(region_loc)
+        i = (loc[1] % REGION_SIZE) * REGION_SIZE + loc[0] % REGION_SIZE
+        self.tilemap.region_counts[region_loc] += bool(tile_id) - bool(region.grid[i])
+        region.grid[i] = tile_id
+        region.dirty = True
+
+    def __delitem__(self, loc):
+        if not self.get(loc):
+            raise KeyError(loc)
+        self[loc] = 0
+
+    def pop(self, loc, default=0):
+        tile_id = self.get(loc)
+        if not tile_id:
+            return default
+        self[loc] = 0
+        return tile_id
+
+    def __iter__(self):
+        for region_loc in sorted(self.tilemap.region_counts):
+            region = self.tilemap.region(region_loc)
+            for i in np.flatnonzero(np.frombuffer(region.grid, dtype=np.uint16)).tolist():
+                yield (region_loc[0] * REGION_SIZE + i % REGION_SIZE, region_loc[1] * REGION_SIZE + i // REGION_SIZE)
+
+    def __len__(self):
+        return self.tilemap.tile_count
+
+class StreamingTilemap(Tilemap):
+    # A Tilemap whose tiles live in region files. stream() is called every frame with the camera's rect to read the regions
+    # around it in the background, and the least recently used ones are dropped once more than MAX_REGIONS are loaded.
+    # Anything that touches a region that isn't loaded reads it there and then, so nothing outside this class has to care.
+    sparse_limit = None # Every tile is in sparse (the regions), there's no dense grid to move them into
+
+    def __init__(self, game, tile_size=16):
+        super().__init__(game, tile_size)
+        self.world_dir = None
+        self.regions = OrderedDict() # Loaded regions by location, least recently used first
+        self.region_counts = {} # Grid tiles in every region of the world, loaded or not (a region exists if it's in here)
+        self.pending = {} # Regions being read on REGION_LOADER by location
+        self.extracted = set() # (type, variant) pairs taken out by extract(), also left out of any region read after it
+        self.markers = {} # Location -> [type, variant, x, y, offgrid] for the MARKER_TYPES tiles in that region's file (None if unknown)
+        self.spilled = {} # Regions with unsaved edits dropped to make room, location -> their markers, see evict()
+        self.spill_dir = None
+        self.sparse = RegionTiles(self)
+
+    def load(self, path):
+        # Only reads the manifest, regions are read as they're needed
+        f = open(os.path.join(path, 'world.json'), 'r')
+        manifest = json.load(f)
+        f.close()
+        if manifest['region_size'] != REGION_SIZE:
+            raise ValueError(path + ' has ' + str(manifest['region_size']) + ' tile regions, expected ' + str(REGION_SIZE))
+
+        self.world_dir = path
+        self.tile_size = manifest['tile_size']
+        self.reset_types(manifest['tile_types'])
+        self.regions = OrderedDict()
+        self.region_counts = {tuple(int(v) for v in loc.split(';')): count for loc, count in manifest['regions'].items()}
+        self.pending = {}
+        self.extracted = set()
+        # Worlds saved before markers were added have none, extract() reads every region for those until they're saved again
+        self.markers = {tuple(int(v) for v in loc.split(';')): markers for loc, markers in manifest['markers'].items()} if 'markers' in manifest else None
+        self.spilled = {}
+        self.tile_count = sum(self.region_counts.values())
+        self.grid_index = self.offgrid_index = self.offgrid_buckets = None
+        self.invalidate_all()
+
+    def save(self, path):
+        # Writes only the regions edited since they were read (every region if path is a different directory) and the manifest.
+        # Markers are kept from the manifest for regions that aren't written, unless it had none and every region has to be read.
+        copy = self.world_dir is None or os.path.abspath(path) != os.path.abspath(self.world_dir)
+        known = self.markers if self.markers is not None and not copy else None
+        os.makedirs(path, exist_ok=True)
+        markers = {}
+        for loc in sorted(self.region_counts):
+            region = self.regions.get(loc)
+            if region is None and (known is None or loc in self.spilled):
+                region = self.region(loc)
+            if region and (region.dirty or copy):
+                self.write_region(region_path(path, loc), region)
+                region.dirty = False
+                markers[loc] = self.find_markers(region)
+            elif known is None:
+                markers[loc] = self.find_markers(region)
+            elif loc in known:
+                markers[loc] = known[loc]
+        self.markers = {loc: region_markers for loc, region_markers in markers.items() if region_markers}
+
+        f = open(os.path.join(path, 'world.json'), 'w')
+        json.dump({'tile_size': self.tile_size, 'region_size': REGION_SIZE, 'tile_types': self.tile_types,
+                   'regions': {str(loc[0]) + ';' + str(loc[1]): count for loc, count in self.region_counts.items()},
+                   'markers': {str(loc[0]) + ';' + str(loc[1]): region_markers for loc, region_markers in self.markers.items()}}, f)
+        f.close()
+        self.world_dir = path
+
+    def write_region(self, path, region):
+        offgrid = [(tile['pos'][0], tile['pos'][1], pack_tile(self.type_id(tile['type']), tile['variant'])) for tile in region.offgrid]
+        save_region(path, REGION_SIZE, region.grid, offgrid)
+
+    def find_markers(self, region):
+        # The manifest entry for a region: its MARKER_TYPES tiles, offgrid first then grid, in the order extract() gives them
+        markers = [[tile['type'], tile['variant'], tile['pos'][0], tile['pos'][1], True] for tile in region.offgrid if tile['type'] in MARKER_TYPES]
+        types = [self.type_ids[tile_type] + 1 for tile_type in MARKER_TYPES if tile_type in self.type_ids]
+        ids = np.frombuffer(region.grid, dtype=np.uint16)
+        for i in np.flatnonzero(np.isin(ids >> 8, types)).tolist():
+            tile_id = int(ids[i])
+            pos = [(region.loc[0] * REGION_SIZE + i % REGION_SIZE) * self.tile_size, (region.loc[1] * REGION_SIZE + i // REGION_SIZE) * self.tile_size]
+            markers.append([self.tile_types[(tile_id >> 8) - 1], tile_id & 0xFF, pos[0], pos[1], False])
+        return markers
+
+    def region(self, loc):
+        # The region at loc, read in first if it isn't loaded (None if the world has nothing there), it's now the most recently used
+        region = self.regions.get(loc)
+        if region is not None:
+            self.regions.move_to_end(loc)
+        elif loc in self.spilled:
+            del self.spilled[loc]
+            region = self.install(loc, *load_region(self.spill_path(loc)))
+            region.dirty = True # Still not saved to the world
+        elif loc in self.region_counts:
+            future = self.pending.pop(loc, None)
+            region = self.install(loc, *(future.result() if future else load_region(region_path(self.world_dir, loc))))
+        return region
+
+    def create_region(self, loc):
+        region = Region(loc)
+        self.evict(1)
+        self.regions[loc] = region
+        self.region_counts[loc] = 0
+        return region
+
+    def install(self, loc, grid, offgrid):
+        region = Region(loc, grid, [{'type': self.tile_types[(tile_id >> 8) - 1], 'variant': tile_id & 0xFF, 'pos': [x, y]} for x, y, tile_id in offgrid])
+        if self.extracted:
+            self.strip(region, self.extracted)
+        count = int(np.count_nonzero(np.frombuffer(grid, dtype=np.uint16)))
+        self.tile_count += count - self.region_counts[loc] # The manifest's count is out of date if tiles were extracted since
+        self.region_counts[loc] = count
+        self.evict(1) # Room is made first, so the region being read in is never the one dropped
+        self.regions[loc] = region
+        if self.offgrid_buckets is not None:
+            for tile in region.offgrid:
+                self.bucket_offgrid(tile)
+        return region
+
+    def evict(self, room=0):
+        # Drops the least recently used regions until no more than MAX_REGIONS - room are loaded. Ones without unsaved edits go
+        # first, they're just read again. Edited ones are written to a scratch file, region() reads them back from there and
+        # save() writes them into the world.
+        excess = len(self.regions) + room - MAX_REGIONS
+        if excess > 0:
+            for loc in [loc for loc, region in self.regions.items() if not region.dirty][:excess]:
+                self.drop_region(loc)
+                excess -= 1
+            for loc in list(self.regions)[:max(excess, 0)]:
+                region = self.drop_region(loc)
+                self.write_region(self.spill_path(loc), region)
+                self.spilled[loc] = self.find_markers(region)
+
+    def spill_path(self, loc):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.TemporaryDirectory(prefix='world-') # Removed with the tilemap
+        return region_path(self.spill_dir.name, loc)
+
+    def drop_region(self, loc):
+        # Forgets a region and everything cached from it, it's read again from its file the next time it's needed
+        region = self.regions.pop(loc)
+        self.invalidate_region(loc)
+        if self.offgrid_buckets is not None:
+            for tile in region.offgrid:
+                self.unbucket_offgrid(tile)
+        return region
+
+    def invalidate_region(self, loc):
+        for cx in range(loc[0] * REGION_CHUNKS, (loc[0] + 1) * REGION_CHUNKS):
+            for cy in range(loc[1] * REGION_CHUNKS, (loc[1] + 1) * REGION_CHUNKS):
+                self.chunks.pop((cx, cy), None)
+
+    def stream(self, rect):
+        # Marks the regions rect (in pixels) covers as just used and starts reading the ones around it that aren't loaded yet.
+        # Reads that have finished are swapped in here, on the main thread.
+        for loc, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[loc]
+                self.install(loc, *future.result())
+        region_px = REGION_SIZE * self.tile_size
+        for rx in range(rect.left // region_px - STREAM_MARGIN, (rect.right - 1) // region_px + STREAM_MARGIN + 1):
+            for ry in range(rect.top // region_px - STREAM_MARGIN, (rect.bottom - 1) // region_px + STREAM_MARGIN + 1):
+                if (rx, ry) in self.regions:
+                    self.regions.move_to_end((rx, ry))
+                elif (rx, ry) in self.region_counts and (rx, ry) not in self.pending and (rx, ry) not in self.spilled:
+                    self.pending[(rx, ry)] = REGION_LOADER.submit(load_region, region_path(self.world_dir, (rx, ry)))
+
+    def snapshot(self):
+        # Nothing needs keeping, every region can be read back from its file (extracted tiles stay out), so restore() just reads
+        # the regions edited since in again
+        return None
+
+    def restore(self, snapshot):
+        edited = [loc for loc, region in self.regions.items() if region.dirty]
+        for loc in edited:
+            for tile in self.drop_region(loc).offgrid:
+                self.invalidate_offgrid(tile) # Decor can hang over into the next region's chunks
+        if self.spilled:
+            edited += list(self.spilled)
+            self.spilled = {}
+            self.invalidate_all() # The spilled regions' decor isn't at hand to invalidate just its chunks
+        for loc in edited:
+            if self.world_dir and os.path.exists(region_path(self.world_dir, loc)):
+                self.region(loc) # Also puts the tile count back
+            else:
+                self.tile_count -= self.region_counts.pop(loc)
+
+    def compact(self):
+        pass # Regions are a fixed size, there's no dense grid to grow
+
+    def autotile(self):
+        # Region by region, each as one block. Autotiling never changes a tile's type, so the row or column touching each side
+        # can be read from the neighbouring region whether or not that one has been done yet. The neighbours are read first, so
+        # reading them in can't evict the region being written to.
+        for loc in sorted(self.region_counts):
+            padded = np.zeros((REGION_SIZE + 2, REGION_SIZE + 2), dtype=np.uint16)
+            left, right, above, below = (self.region((loc[0] + dx, loc[1] + dy)) for dx, dy in ((-1, 0), (1, 0), (0, -1), (0, 1)))
+            if left:
+                padded[1:-1, 0] = region_ids(left)[:, -1] >> 8
+            if right:
+                padded[1:-1, -1] = region_ids(right)[:, 0] >> 8
+            if above:
+                padded[0, 1:-1] = region_ids(above)[-1] >> 8
+            if below:
+                padded[-1, 1:-1] = region_ids(below)[0] >> 8
+            region = self.region(loc)
+            ids = region_ids(region)
+            padded[1:-1, 1:-1] = ids >> 8
+            gy, gx = self.autotile_block(ids, padded)
+            if len(gy):
+                region.dirty = True
+                for chunk_loc in set(zip((gx // CHUNK_SIZE + loc[0] * REGION_CHUNKS).tolist(), (gy // CHUNK_SIZE + loc[1] * REGION_CHUNKS).tolist())):
+                    self.chunks.pop(chunk_loc, None)
+        self.grid_index = self.offgrid_index = None # Variants are part of the ids it's keyed by
+
+    def build_collision(self):
+        pass # There's no dense grid to pack a solid bitmap for, raycasts read the regions through sparse
+
+    def extract(self, id_pairs, keep=False):
+        # Matches come out grouped by id pair, offgrid tiles first, like Tilemap.extract. MARKER_TYPES tiles come from the manifest
+        # (or the region itself if it has unsaved edits), anything else means going through every region. Unless keep, the pairs
+        # are also stripped from every region read from now on, so extracting doesn't leave regions stuck in memory as edited.
+        offgrid_matches = {pair: [] for pair in id_pairs}
+        grid_matches = {pair: [] for pair in id_pairs}
+        if self.markers is not None and all(tile_type in MARKER_TYPES for tile_type, variant in id_pairs):
+            for loc in sorted(self.region_counts):
+                region = self.regions.get(loc)
+                markers = self.find_markers(region) if region and region.dirty else self.spilled[loc] if loc in self.spilled else self.markers.get(loc, ())
+                for tile_type, variant, x, y, offgrid in markers:
+                    if (tile_type, variant) in offgrid_matches and (tile_type, variant) not in self.extracted:
+                        (offgrid_matches if offgrid else grid_matches)[(tile_type, variant)].append({'type': tile_type, 'variant': variant, 'pos': [x, y]})
+            if not keep:
+                for region in list(self.regions.values()):
+                    self.strip(region, id_pairs)
+                self.extracted.update(id_pairs)
+            return [tile for pair in id_pairs for tile in offgrid_matches[pair]] + [tile for pair in id_pairs for tile in grid_matches[pair]]
+
+        grid_ids = {pack_tile(self.type_ids[tile_type], variant): (tile_type, variant) for tile_type, variant in id_pairs if tile_type in self.type_ids}
+        for loc in sorted(self.region_counts):
+            region = self.region(loc)
+            for tile in region.offgrid:
+                if (tile['type'], tile['variant']) in offgrid_matches:
+                    offgrid_matches[(tile['type'], tile['variant'])].append(tile.copy())
+            ids = np.frombuffer(region.grid, dtype=np.uint16)
+            for i in np.flatnonzero(np.isin(ids, list(grid_ids))).tolist():
+                tile_type, variant = grid_ids[int(ids[i])]
+                pos = [(loc[0] * REGION_SIZE + i % REGION_SIZE) * self.tile_size, (loc[1] * REGION_SIZE + i // REGION_SIZE) * self.tile_size]
+                grid_matches[(tile_type, variant)].append({'type': tile_type, 'variant': variant, 'pos': pos})
+            if not keep:
+                self.strip(region, id_pairs)
+        if not keep:
+            self.extracted.update(id_pairs)
+        return [tile for pair in id_pairs for tile in offgrid_matches[pair]] + [tile for pair in id_pairs for tile in grid_matches[pair]]
+
+    def strip(self, region, id_pairs):
+        # Takes every tile matching id_pairs out of a region without marking it as edited
+        id_pairs = set(id_pairs)
+        kept = []
+        for tile in region.offgrid:
+            if (tile['type'], tile['variant']) in id_pairs:
+                if self.offgrid_buckets is not None and region.loc in self.regions:
+                    self.unbucket_offgrid(tile)
+                self.invalidate_offgrid(tile)
+            else:
+                kept.append(tile)
+        region.offgrid = kept
+
+        ids = np.frombuffer(region.grid, dtype=np.uint16)
+        stripped = np.isin(ids, [pack_tile(self.type_ids[tile_type], variant) for tile_type, variant in id_pairs if tile_type in self.type_ids])
+        if stripped.any():
+            ids[stripped] = 0
+            self.region_counts[region.loc] -= int(np.count_nonzero(stripped))
+            self.tile_count -= int(np.count_nonzero(stripped))
+            self.invalidate_region(region.loc)
+
+    def offgrid_region(self, tile):
+        return (math.floor(tile['pos'][0] / self.tile_size) // REGION_SIZE, math.floor(tile['pos'][1] / self.tile_size) // REGION_SIZE)
+
+    def add_offgrid(self, tile):
+        loc = self.offgrid_region(tile)
+        region = self.region(loc) or self.create_region(loc)
+        region.offgrid.append(tile)
+        region.dirty = True
+        if self.offgrid_buckets is not None:
+            self.bucket_offgrid(tile)
+        self.invalidate_offgrid(tile)
+
+    def remove_offgrid(self, tile):
+        region = self.region(self.offgrid_region(tile))
+        region.offgrid.remove(tile)
+        region.dirty = True
+        if self.offgrid_buckets is not None:
+            self.unbucket_offgrid(tile)
+        self.invalidate_offgrid(tile)
+
+    def build_offgrid_buckets(self):
+        if self.offgrid_buckets is None:
+            self.offgrid_buckets = {}
+            for region in self.regions.values():
+                for tile in region.offgrid:
+                    self.bucket_offgrid(tile)
+
+    def load_near_chunk(self, chunk_loc):
+        # Decor over a chunk can come from the chunks left of and above it as well as its own (offgrid images are smaller than
+        # a chunk), so all of their regions need to be loaded before the chunk's bucket is complete
+        for cx in (chunk_loc[0] - 1, chunk_loc[0]):
+            for cy in (chunk_loc[1] - 1, chunk_loc[1]):
+                self.region((cx // REGION_CHUNKS, cy // REGION_CHUNKS))
+
+    def bake_chunk(self, chunk_loc):
+        self.load_near_chunk(chunk_loc)
+        super().bake_chunk(chunk_loc)
+
+    def offgrid_at(self, pos):
+        chunk_px = self.tile_size * CHUNK_SIZE
+        self.load_near_chunk((math.floor(pos[0]) // chunk_px, math.floor(pos[1]) // chunk_px))
+        return super().offgrid_at(pos)